@@ -21,18 +21,122 @@
 # Cross validation and grid search routines meant to be applied
 # to pipelines that take pandas objects.
 
+import json
 import sys
-import time # for random seeds
+import time
+from collections import OrderedDict
+from itertools import izip
 
 import numpy as np
 import pandas as pd
 from sklearn.grid_search import IterGrid
-from sklearn.cross_validation import KFold
 from sklearn.metrics import mean_squared_error
+from sklearn.pipeline import Pipeline
+
+from parallel import run_tasks, effective_n_jobs
+from util import current_rss
+
+# direction to walk a parameter in so that each fit can warm start from
+# the previous one: from heavy to light regularization, small to large
+# ensembles
+WARM_START_ORDER = {'alpha': 'descending',
+                    'C': 'ascending',
+                    'n_estimators': 'ascending'}
+
+class FoldPlan(object):
+    """
+    A precomputed k-fold split of n rows.  Build one plan and pass it to
+    cv_dataframe or DataFrameCV to score every configuration on exactly
+    the same folds.
+
+    Only the fold number of each row is stored (fold_ids, as int32).
+    The training and test rows of a fold are built as sorted index
+    arrays when the fold is requested, and selecting them copies the
+    rows.  The exception is the test fold of a plan without shuffling
+    or stratification, which is a contiguous block and is returned as a
+    slice, so it selects a view of an ndarray (or memory-mapped array).
+    """
+    def __init__(self, n, n_folds=5, shuffle=True, random_state=0,
+                 stratify=None):
+        """
+        Parameters:
+        ----------
+        n: number of rows in the data set
+
+        n_folds: number of folds
+
+        shuffle: if True, assign rows to folds at random
+
+        random_state: seed used when shuffling
+
+        stratify: optional array of n class labels; if given, each class
+           is spread as evenly as possible across the folds
+
+        ValueError is raised unless 2 <= n_folds <= n, and stratify (if
+        given) has n labels.
+        """
+        if not 2 <= n_folds <= n:
+            raise ValueError('n_folds must be between 2 and the number of '
+                             'rows (%d), got %r' % (n, n_folds))
+        if stratify is not None and len(stratify) != n:
+            raise ValueError('Got %d labels to stratify on, but %d rows' % 
+                             (len(stratify), n))
+        self.n = n
+        self.n_folds = n_folds
+        self.shuffle = shuffle
+        self.random_state = random_state
+
+        rng = np.random.RandomState(random_state)
+        if stratify is not None:
+            labels = np.asarray(stratify)
+            order = np.arange(n)
+            if shuffle:
+                order = rng.permutation(n)
+            # group rows by class (keeping the shuffled order within each
+            # class), then deal them out to the folds in turn
+            order = order[np.argsort(labels[order], kind='mergesort')]
+            self.fold_ids = np.empty(n, dtype=np.int32)
+            self.fold_ids[order] = np.arange(n) % n_folds
+        else:
+            order = rng.permutation(n) if shuffle else np.arange(n)
+            sizes = np.repeat(n // n_folds, n_folds)
+            sizes[:n % n_folds] += 1
+            self.fold_ids = np.empty(n, dtype=np.int32)
+            self.fold_ids[order] = np.repeat(np.arange(n_folds), sizes)
+        self._contiguous = not shuffle and stratify is None
+
+    def __len__(self):
+        return self.n_folds
+
+    def __getitem__(self, i):
+        """(train, test) rows of fold i."""
+        if not 0 <= i < self.n_folds:
+            raise IndexError('fold index out of range')
+        in_test = self.fold_ids == i
+        train = np.flatnonzero(~in_test)
+        if self._contiguous:
+            start = np.searchsorted(self.fold_ids, i)
+            test = slice(start, start + len(self.fold_ids) - len(train))
+        else:
+            test = np.flatnonzero(in_test)
+        return train, test
+
+    def __iter__(self):
+        for i in xrange(self.n_folds):
+            yield self[i]
+
+def take_rows(X, rows):
+    """Select rows of an ndarray, DataFrame or Series by an integer index
+    array (or a slice, which gives a view where possible)."""
+    if isinstance(rows, slice):
+        return X[rows]
+    else:
+        return X.take(rows, axis=0)
 
 def cv_dataframe(model, X, y, error_fn=mean_squared_error, 
                  score_fn=None, n_folds=5, verbose=True, 
-                 predict_method='predict'):
+                 predict_method='predict', n_jobs=1, random_state=0,
+                 folds=None, telemetry=None):
     """
     Run k-fold cross validation over a training data set.
     Returns the mean error or score across all folds.
@@ -41,10 +145,10 @@ def cv_dataframe(model, X, y, error_fn=mean_squared_error,
     ----------
     model: A predictor implementing fit and predict information.
 
-    X: training data that is capable of being indexed with a boolean
-       array (e.g., DataFrame or 2D ndarray).
+    X: training data supporting take() along rows (e.g., DataFrame or
+       2D ndarray).
 
-    y: target values to be fit by the model
+    y: target values to be fit by the model (Series or ndarray)
 
     error_fn: defaults to mean_squared_error; takes precedence if no
        score_fn defined.  Should follow scikit-learn convention for
@@ -60,35 +164,72 @@ def cv_dataframe(model, X, y, error_fn=mean_squared_error,
     predict_method: defaults to 'predict', which is fine except for 
        certain cases where an alternative prediction type is desired
        (e.g., predict_proba on certain classifiers)
+
+    n_jobs: number of processes to run folds in; -1 uses every CPU.
+       When greater than 1, each fold fits its own copy of the model in
+       a worker process, and X and y are shared with the workers rather
+       than copied.  The model passed in is then left unfitted.
+
+    random_state: seed for shuffling rows into folds.  Fixed by default
+       so that repeated, serial and parallel runs all use the same folds.
+
+    folds: optional FoldPlan to use instead of building one from n_folds
+       and random_state.
+
+    telemetry: optional list.  If given, a record (dict) is appended for
+       each fold with its fold number, result, training and test row
+       counts, fit and predict times in seconds, rows per second for
+       each, the resident set size in bytes of the process that ran
+       it just after the fit (rss), and the change in it over the fit
+       (rss_growth).  rss_growth is the memory the fit left allocated,
+       mostly the fitted model; temporary allocations freed during the
+       fit don't show, and it may be negative if the fit freed memory.
+       Both are NaN on platforms without /proc/self/statm.
     """
     if score_fn is not None:
         use_score = True
         result_type = 'score'
+        eval_fn = score_fn
     else:
         use_score = False
         result_type = 'error'
+        eval_fn = error_fn
 
-    folds = KFold(len(X), n_folds=n_folds, indices=False, shuffle=True,
-                  random_state=int(time.time()))
-    results = []
+    if folds is None:
+        folds = FoldPlan(len(X), n_folds, random_state=random_state)
+    n_folds = len(folds)
+    shared = {'X': X, 'y': y, 'folds': folds}
     if verbose:
         print 'Performing cross validation...'
-    for i, (train, test) in enumerate(folds):
-        if verbose:
-            sys.stdout.write('Fold {0}/{1}...'.format(i + 1, n_folds))
-            sys.stdout.flush()
-        
-        model.fit(X[train], y[train])
-        y_cv = y[test]
-        yhat_cv = model.predict(X[test])
-
-        if use_score:
-            results.append(score_fn(y_cv, yhat_cv))
-        else:
-            results.append(error_fn(y_cv, yhat_cv))
-            
+
+    if n_jobs == 1:
+        records = []
+        for i in xrange(n_folds):
+            if verbose:
+                sys.stdout.write('Fold {0}/{1}...'.format(i + 1, n_folds))
+                sys.stdout.flush()
+
+            records.append(_fit_and_evaluate(shared, model, i, eval_fn,
+                                             predict_method))
+
+            if verbose:
+                print 'done! ({0}: {1})'.format(result_type, 
+                                                records[-1]['result'])
+    else:
+        # each task gets its own pickled copy of the model in the pool
+        tasks = [(model, i, eval_fn, predict_method)
+                 for i in xrange(n_folds)]
+        records = run_tasks(_fit_and_evaluate, tasks, shared, n_jobs)
         if verbose:
-            print 'done! ({0}: {1})'.format(result_type, results[-1])
+            for i, record in enumerate(records):
+                print 'Fold {0}/{1}: {2} = {3}'.format(
+                    i + 1, n_folds, result_type, record['result'])
+
+    results = [record['result'] for record in records]
+    if telemetry is not None:
+        for i, record in enumerate(records):
+            record['fold'] = i
+            telemetry.append(record)
 
     final_result = np.mean(results)
     if verbose:
@@ -96,20 +237,189 @@ def cv_dataframe(model, X, y, error_fn=mean_squared_error,
 
     return final_result
 
+def _fit_cached_and_evaluate(shared, head, tail, param_list, fold, eval_fn,
+                             predict_method):
+    # fit the leading pipeline steps on a fold once, then fit and
+    # evaluate the trailing pipeline with each parameter set on the
+    # transformed data
+    cached = _fit_head(shared, head, fold)
+    return _evaluate_tails(shared, cached, fold, tail, param_list, eval_fn, 
+                           predict_method)
+
+def _evaluate_cached(shared, fold, tail, param_list, eval_fn, 
+                     predict_method):
+    # evaluate the trailing pipeline with some of the parameter sets on a
+    # fold's transformed data, computed beforehand by _fit_head and held
+    # in the shared dict
+    return _evaluate_tails(shared, shared['cached'][fold], fold, tail, 
+                           param_list, eval_fn, predict_method)
+
+def _fit_head(shared, head, fold):
+    # fit the leading pipeline steps on the training part of a fold;
+    # returns both parts of the fold transformed, and the time taken
+    X, y = shared['X'], shared['y']
+    train, test = shared['folds'][fold]
+    start = time.time()
+    Xt_train = head.fit_transform(take_rows(X, train), take_rows(y, train))
+    Xt_cv = head.transform(take_rows(X, test))
+    return Xt_train, Xt_cv, time.time() - start
+
+def _evaluate_tails(shared, cached, fold, tail, param_list, eval_fn, 
+                    predict_method):
+    y = shared['y']
+    train, test = shared['folds'][fold]
+    y_train, y_cv = take_rows(y, train), take_rows(y, test)
+    Xt_train, Xt_cv, cached_time = cached
+
+    records = []
+    for params in param_list:
+        tail.set_params(**params)
+        record = _timed_evaluate(tail, Xt_train, y_train, Xt_cv, y_cv,
+                                 eval_fn, predict_method)
+        record['cached_time'] = cached_time
+        records.append(record)
+    return records
+
+def _fit_and_evaluate(shared, model, fold, eval_fn, predict_method, 
+                      params=None):
+    # fit model (with params set, if given) on the training part of a fold
+    # and evaluate it on the held out part; X, y and folds come from the
+    # shared dict
+    if params is not None:
+        model.set_params(**params)
+    X, y = shared['X'], shared['y']
+    train, test = shared['folds'][fold]
+    return _timed_evaluate(model, take_rows(X, train), take_rows(y, train),
+                           take_rows(X, test), take_rows(y, test),
+                           eval_fn, predict_method)
+
+def _fit_path_and_evaluate(shared, head, tail, warm_key, paths, fold, 
+                           eval_fn, predict_method):
+    # optionally fit the leading pipeline steps on a fold once, then walk
+    # each path of parameter sets with the tail estimator, starting each
+    # path from scratch and warm starting every later fit from the one
+    # before, evaluating after every fit; results come back in path order
+    X, y = shared['X'], shared['y']
+    train, test = shared['folds'][fold]
+    y_train, y_cv = take_rows(y, train), take_rows(y, test)
+    X_train, X_cv = take_rows(X, train), take_rows(X, test)
+    start = time.time()
+    if head is not None:
+        X_train = head.fit_transform(X_train, y_train)
+        X_cv = head.transform(X_cv)
+    cached_time = time.time() - start
+
+    records = []
+    for path in paths:
+        for i, params in enumerate(path):
+            tail.set_params(**params)
+            tail.set_params(**{warm_key: i > 0})
+            record = _timed_evaluate(tail, X_train, y_train, X_cv, y_cv,
+                                     eval_fn, predict_method)
+            record['cached_time'] = cached_time
+            records.append(record)
+    return records
+
+def _timed_evaluate(model, X_train, y_train, X_cv, y_cv, eval_fn, 
+                    predict_method):
+    # fit and score a model, returning a telemetry record of the run
+    start_rss = current_rss()
+    start = time.time()
+    model.fit(X_train, y_train)
+    fit_time = time.time() - start
+    fit_rss = current_rss()
+
+    start = time.time()
+    yhat_cv = getattr(model, predict_method)(X_cv)
+    predict_time = time.time() - start
+
+    n_train, n_test = len(y_train), len(y_cv)
+    return {'result': eval_fn(y_cv, yhat_cv),
+            'n_train': n_train,
+            'n_test': n_test,
+            'fit_time': fit_time,
+            'predict_time': predict_time,
+            'train_rows_per_sec': _rate(n_train, fit_time),
+            'predict_rows_per_sec': _rate(n_test, predict_time),
+            'rss': fit_rss,
+            'rss_growth': fit_rss - start_rss}
+
+def _rate(n, seconds):
+    if seconds > 0:
+        return n / seconds
+    else:
+        return np.nan
+
 class DataFrameCV(object):
     """
     Stripped-down version of of GridSearchCV with the ability to work with
-    DataFrames.  Does not yet support parallelism or a few of the more
-    complex GridSearchCV features.
+    DataFrames.  Does not support a few of the more complex GridSearchCV
+    features.
+
+    With n_jobs > 1, every (parameter set, fold) pair is scheduled as a
+    separate task on one shared pool of worker processes, so the whole
+    grid is spread across the available cores.
+
+    If the model is a Pipeline and the grid only sets parameters of its
+    later steps (e.g. only predictor__* parameters from
+    learn.get_pipeline), the earlier steps are fit and applied once per
+    fold and their output is reused for every parameter set, unless
+    cache_stages is False.  With n_jobs no greater than the number of
+    folds, each fold is one task; with more, the cached output of every
+    fold is kept in memory at once and the grid is split into chunks
+    that are evaluated in parallel on it, trading memory for the use
+    of every worker.
+
+    With search='halving', the grid is searched by successive halving
+    instead: every parameter set is scored on min_folds folds, the best
+    1/halving_factor of them (by score or error, as configured) are
+    kept, and the survivors are scored on halving_factor times as many
+    folds, until the last round uses all n_folds.  halving_factor must be
+    an integer >= 2 and min_folds an integer from 1 to the number of
+    folds, or fit raises ValueError.  Only the survivors of the final
+    round compete for best_result, which is always a mean over all
+    n_folds.  Stage caching is not used in this mode.
+
+    With warm_start=True, grid points that differ only in warm-startable
+    parameters are fit in sequence on each fold by a single estimator
+    with warm_start enabled, so each fit starts from the previous one.
+    warm_start_params maps grid keys to 'ascending' or 'descending', the
+    order to walk them in; by default it is inferred from the parameter
+    name using WARM_START_ORDER (e.g. alpha from strong to weak
+    regularization, n_estimators upwards).  The final estimator must
+    accept a warm_start parameter.  Stage caching still applies.
+
+    Every configuration is scored on the same folds: either the FoldPlan
+    passed as folds, or one built from n_folds and random_state at the
+    start of fit (kept as fold_plan).
+
+    Each fit of a configuration on a fold is recorded in telemetry_records
+    (see cv_dataframe for the fields; params is added, and cached_time
+    gives the time spent on cached pipeline steps).  get_telemetry()
+    returns them as a DataFrame and write_telemetry() as JSON lines.
     """
     def __init__(self, model, params, n_folds=5, error_fn=mean_squared_error, 
-                 score_fn=None, verbose=False):
+                 score_fn=None, verbose=False, n_jobs=1, random_state=0,
+                 cache_stages=True, search='grid', halving_factor=3,
+                 min_folds=1, folds=None, warm_start=False, 
+                 warm_start_params=None):
         self.model = model
         self.params = params
         self.n_folds = n_folds
         self.error_fn = error_fn
         self.score_fn = score_fn
         self.verbose = verbose
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.cache_stages = cache_stages
+        self.search = search
+        self.halving_factor = halving_factor
+        self.min_folds = min_folds
+        self.folds = folds
+        self.fold_plan = None
+        self.warm_start = warm_start
+        self.warm_start_params = warm_start_params
+        self.telemetry_records = []
 
         if self.score_fn is not None:
             self.use_score = True
@@ -121,30 +431,44 @@ class DataFrameCV(object):
 
     def fit(self, X, y):
         self._reset_estimator_stats()
-        param_iter = IterGrid(self.params)
+        if self.folds is not None:
+            self.fold_plan = self.folds
+        else:
+            self.fold_plan = FoldPlan(len(X), self.n_folds, 
+                                      random_state=self.random_state)
+        param_list = list(IterGrid(self.params))
         if self.verbose:
             print '*** Beginning cross validation grid search ***'
-        for params in param_iter:
-            if self.verbose:
-                print 'Executing CV run:', params
-            self.model.set_params(**params)
-            result = cv_dataframe(self.model, X, y, self.error_fn, 
-                                  self.score_fn, n_folds=self.n_folds,
-                                  verbose=self.verbose)
-            if self.use_score:
-                # this means higher results are better
-                if self.best_result is None or result > self.best_result:
-                    self.best_result = result
-                    self.best_params = params
-            else:
-                if self.best_result is None or result < self.best_result:
-                    self.best_result = result
-                    self.best_params = params
 
-            if self.verbose:
-                print 'Finished run; result = {0} (best = {1})'.format(
-                    result, self.best_result
-                    )
+        stage = self._cached_stage_index(param_list)
+        if self.search == 'halving':
+            survivors, results = self._halving_search(X, y, param_list)
+            param_list = [param_list[i] for i in survivors]
+        elif self.search != 'grid':
+            raise ValueError('Unknown search mode %s' % self.search)
+        elif self.warm_start:
+            results = self._warm_start_grid(X, y, param_list, stage)
+        elif stage > 0:
+            results = self._cached_grid(X, y, param_list, stage)
+        elif self.n_jobs != 1:
+            results = self._parallel_grid(X, y, param_list)
+        else:
+            results = []
+            for params in param_list:
+                if self.verbose:
+                    print 'Executing CV run:', params
+                self.model.set_params(**params)
+                records = []
+                result = cv_dataframe(self.model, X, y, self.error_fn, 
+                                      self.score_fn, verbose=self.verbose,
+                                      folds=self.fold_plan, 
+                                      telemetry=records)
+                for record in records:
+                    self._add_telemetry(params, record['fold'], record)
+                results.append(result)
+
+        for params, result in izip(param_list, results):
+            self._update_best(params, result)
                 
         if self.verbose:
             print '*** Complete ***'
@@ -157,9 +481,278 @@ class DataFrameCV(object):
                 )
 
     def predict(self, X):
-        return self.model.fit(X, y)
+        return self.model.predict(X)
+
+    def _parallel_grid(self, X, y, param_list):
+        # Evaluate every parameter set on every fold in one pool, and
+        # return the mean result for each parameter set.
+        eval_fn = self._get_eval_fn()
+        folds = self.fold_plan
+        shared = {'X': X, 'y': y, 'folds': folds}
+        tasks = []
+        for params in param_list:
+            for fold in xrange(len(folds)):
+                tasks.append((self.model, fold, eval_fn, 'predict', params))
+
+        if self.verbose:
+            print 'Running {0} CV tasks on {1} processes...'.format(
+                len(tasks), self.n_jobs)
+        records = run_tasks(_fit_and_evaluate, tasks, shared, self.n_jobs)
+        n_folds = len(folds)
+        results = [self._add_telemetry(param_list[i // n_folds], 
+                                       i % n_folds, record)
+                   for i, record in enumerate(records)]
+        return [np.mean(results[i:i + n_folds]) 
+                for i in xrange(0, len(results), n_folds)]
+
+    def _cached_grid(self, X, y, param_list, stage):
+        # Fit and apply the first `stage` pipeline steps once per fold,
+        # then sweep the whole grid over the later steps using the
+        # cached, transformed training and test matrices.  Returns the
+        # mean result for each parameter set.
+        #
+        # With no more workers than folds, there is one task per fold,
+        # which fits the early steps and then every parameter set.  With
+        # more workers, that would leave some idle, so the early steps
+        # are fit in one task per fold first, and their output (held by
+        # this process for all folds at once, and sent back from the
+        # workers once) is then shared by tasks that each evaluate a
+        # chunk of the grid on one fold.
+        eval_fn = self._get_eval_fn()
+        folds = self.fold_plan
+        shared = {'X': X, 'y': y, 'folds': folds}
+
+        steps = self.model.steps
+        head, tail = Pipeline(steps[:stage]), Pipeline(steps[stage:])
+        n_chunks = min(len(param_list), 
+                       effective_n_jobs(self.n_jobs) // len(folds))
+        if self.verbose:
+            print 'Caching pipeline steps {0} across the grid'.format(
+                [name for name, _ in steps[:stage]])
+
+        if n_chunks <= 1:
+            tasks = [(head, tail, param_list, fold, eval_fn, 'predict')
+                     for fold in xrange(len(folds))]
+            fold_records = run_tasks(_fit_cached_and_evaluate, tasks, 
+                                     shared, self.n_jobs)
+        else:
+            tasks = [(head, fold) for fold in xrange(len(folds))]
+            shared['cached'] = run_tasks(_fit_head, tasks, shared, 
+                                         self.n_jobs)
+            chunks = np.array_split(np.arange(len(param_list)), n_chunks)
+            tasks = [(fold, tail, [param_list[i] for i in chunk], eval_fn, 
+                      'predict')
+                     for fold in xrange(len(folds)) for chunk in chunks]
+            chunk_records = run_tasks(_evaluate_cached, tasks, shared,
+                                      self.n_jobs)
+            fold_records = [sum(chunk_records[i:i + n_chunks], []) 
+                            for i in xrange(0, len(tasks), n_chunks)]
+        fold_results = [[self._add_telemetry(params, fold, record)
+                         for params, record in izip(param_list, records)]
+                        for fold, records in enumerate(fold_records)]
+        return list(np.mean(fold_results, axis=0))
+
+    def _halving_search(self, X, y, param_list):
+        # Successive halving over the folds.  Returns the indices of the
+        # parameter sets that survived to the final round, and their mean
+        # results over all folds.
+        folds = self.fold_plan
+        n_folds = len(folds)
+        if (not isinstance(self.halving_factor, (int, long)) or 
+            self.halving_factor < 2):
+            raise ValueError('halving_factor must be an integer >= 2, '
+                             'got %r' % (self.halving_factor,))
+        if (not isinstance(self.min_folds, (int, long)) or 
+            not 1 <= self.min_folds <= n_folds):
+            raise ValueError('min_folds must be an integer between 1 and '
+                             'the number of folds (%d), got %r' % 
+                             (n_folds, self.min_folds))
+
+        eval_fn = self._get_eval_fn()
+        shared = {'X': X, 'y': y, 'folds': folds}
+        fold_results = [[] for _ in param_list]
+
+        candidates = range(len(param_list))
+        budget = self.min_folds
+        while True:
+            # only the folds a candidate hasn't been scored on yet
+            tasks, owners = [], []
+            for c in candidates:
+                for fold in xrange(len(fold_results[c]), budget):
+                    tasks.append((self.model, fold, eval_fn, 'predict',
+                                  param_list[c]))
+                    owners.append(c)
+            records = run_tasks(_fit_and_evaluate, tasks, shared, 
+                                self.n_jobs)
+            for c, record in izip(owners, records):
+                fold = len(fold_results[c])
+                fold_results[c].append(
+                    self._add_telemetry(param_list[c], fold, record))
+
+            if budget >= n_folds:
+                break
+
+            n_keep = int(np.ceil(len(candidates) / 
+                                 float(self.halving_factor)))
+            ranked = sorted(candidates, 
+                            key=lambda c: np.mean(fold_results[c]),
+                            reverse=self.use_score)
+            candidates = sorted(ranked[:n_keep])
+            if len(candidates) == 1:
+                budget = n_folds
+            else:
+                budget = min(budget * self.halving_factor, n_folds)
+            if self.verbose:
+                print 'Keeping {0} candidates; scoring on {1} folds'.format(
+                    len(candidates), budget)
+
+        return candidates, [np.mean(fold_results[c]) for c in candidates]
+
+    def _warm_start_grid(self, X, y, param_list, stage):
+        # Walk each group of grid points along its warm-startable
+        # parameters on every fold, reusing the previous fit.  One task
+        # per fold; returns the mean result for each parameter set.
+        eval_fn = self._get_eval_fn()
+        folds = self.fold_plan
+        shared = {'X': X, 'y': y, 'folds': folds}
+
+        if stage > 0:
+            steps = self.model.steps
+            head, tail = Pipeline(steps[:stage]), Pipeline(steps[stage:])
+        else:
+            head, tail = None, self.model
+
+        if hasattr(tail, 'steps'):
+            warm_key = '{0}__warm_start'.format(tail.steps[-1][0])
+        else:
+            warm_key = 'warm_start'
+        if warm_key not in tail.get_params():
+            raise ValueError('Final estimator does not support warm_start')
+        warm_start = tail.get_params()[warm_key]
+
+        paths = self._warm_start_paths(param_list)
+        path_params = [[param_list[i] for i in path] for path in paths]
+        if self.verbose:
+            print 'Walking {0} warm start paths over {1} folds'.format(
+                len(paths), len(folds))
+
+        tasks = [(head, tail, warm_key, path_params, fold, eval_fn, 
+                  'predict')
+                 for fold in xrange(len(folds))]
+        try:
+            fold_records = run_tasks(_fit_path_and_evaluate, tasks, shared,
+                                     self.n_jobs)
+        finally:
+            # run serially, the walk sets warm_start on the model itself
+            tail.set_params(**{warm_key: warm_start})
+
+        visited = [i for path in paths for i in path]
+        fold_results = [[self._add_telemetry(param_list[i], fold, record)
+                         for i, record in izip(visited, records)]
+                        for fold, records in enumerate(fold_records)]
+        results = [None] * len(param_list)
+        for i, result in izip(visited, np.mean(fold_results, axis=0)):
+            results[i] = result
+        return results
+
+    def _warm_start_paths(self, param_list):
+        # Group grid points by everything except the warm-startable
+        # parameters, then order each group along those parameters.
+        directions = self.warm_start_params
+        if directions is None:
+            directions = {}
+            for params in param_list:
+                for key in params:
+                    name = key.rsplit('__', 1)[-1]
+                    if name in WARM_START_ORDER:
+                        directions[key] = WARM_START_ORDER[name]
+
+        def path_position(i):
+            position = []
+            for key in sorted(directions):
+                value = param_list[i].get(key, 0)
+                if directions[key] == 'descending':
+                    value = -value
+                position.append(value)
+            return position
+
+        groups = OrderedDict()
+        for i, params in enumerate(param_list):
+            fixed = tuple(sorted((key, repr(value)) 
+                                 for key, value in params.iteritems()
+                                 if key not in directions))
+            groups.setdefault(fixed, []).append(i)
+
+        return [sorted(members, key=path_position) 
+                for members in groups.itervalues()]
+
+    def _cached_stage_index(self, param_list):
+        # Index of the first pipeline step touched by any grid parameter.
+        # The steps before it are identical for every parameter set, so
+        # they can be fit once per fold.  0 means nothing can be cached.
+        steps = getattr(self.model, 'steps', None)
+        if not self.cache_stages or steps is None:
+            return 0
+
+        names = [name for name, _ in steps]
+        # the final step is always refit for each parameter set
+        first = len(steps) - 1
+        for params in param_list:
+            for key in params:
+                step_name = key.split('__', 1)[0]
+                if '__' not in key or step_name not in names:
+                    return 0
+                first = min(first, names.index(step_name))
+        return first
+
+    def get_telemetry(self):
+        """Telemetry records of the last fit, one row per configuration
+        and fold, as a DataFrame."""
+        columns = ['params', 'fold', 'result', 'n_train', 'n_test', 
+                   'fit_time', 'predict_time', 'train_rows_per_sec', 
+                   'predict_rows_per_sec', 'rss', 'rss_growth', 
+                   'cached_time']
+        return pd.DataFrame(self.telemetry_records, columns=columns)
+
+    def write_telemetry(self, filename):
+        """Write the telemetry records of the last fit to a file as JSON
+        lines.  Values that JSON can't represent are written as strings."""
+        with open(filename, 'w') as ofile:
+            for record in self.telemetry_records:
+                ofile.write(json.dumps(record, default=repr) + '\n')
+
+    def _add_telemetry(self, params, fold, record):
+        # tag a record with its configuration and fold, store it, and
+        # return its result
+        record['params'] = params
+        record['fold'] = fold
+        self.telemetry_records.append(record)
+        return record['result']
+
+    def _get_eval_fn(self):
+        if self.use_score:
+            return self.score_fn
+        else:
+            return self.error_fn
+
+    def _update_best(self, params, result):
+        if self.use_score:
+            # this means higher results are better
+            if self.best_result is None or result > self.best_result:
+                self.best_result = result
+                self.best_params = params
+        else:
+            if self.best_result is None or result < self.best_result:
+                self.best_result = result
+                self.best_params = params
+
+        if self.verbose:
+            print 'Finished run {0}; result = {1} (best = {2})'.format(
+                params, result, self.best_result
+                )
 
     def _reset_estimator_stats(self):
         self.best_result = None
         self.best_params = None
         self.best_estimator = None
+        self.telemetry_records = []
@@ -24,63 +24,252 @@ from collections import defaultdict
 from itertools import izip
 
 import numpy as np
+from sklearn.base import BaseEstimator, clone
 from sklearn.pipeline import Pipeline
 
-from util import safe_get_values, check_any_null
+from util import safe_get_values, factorize_rows
 
 class Binner(BaseEstimator):
-    """Takes a single column vector of values and converts to bins.
+    """Takes a column vector of values and converts to bins.
     Uses the numpy.digitize function to do the heavy lifting.
+
+    Bin edges are spaced linearly between the minimum and maximum of the
+    data, logarithmically if has_log_bins is set, or at equally spaced
+    quantiles if has_quantile_bins is set, so that bins hold roughly
+    equal numbers of values.  Quantiles come from a QuantileSketch of
+    sketch_size points per column, which is updated chunk by chunk by
+    partial_fit and can be combined across partitions with merge.
+
+    A 2D input is binned column by column, each column getting its own
+    bin edges.  bin_edges then holds a list of edge arrays.
     """
-    def __init__(self, nbins=10, has_log_bins=False):
+    # columns are binned independently, so FeatureMapper.from_rules
+    # may hand several columns sharing a rule to a single Binner
+    batch_columns = True
+
+    def __init__(self, nbins=10, has_log_bins=False, has_quantile_bins=False,
+                 sketch_size=1000):
         self.nbins = nbins
         self.has_log_bins = has_log_bins
+        self.has_quantile_bins = has_quantile_bins
+        self.sketch_size = sketch_size
         self.bin_edges = None
         self._offset = 0
+        self._minval = None
+        self._maxval = None
+        self._sketches = None
+        self._ndim = 1
 
     def fit(self, X, y=None):
-        self._offset = 0
-        minval, maxval = None, None
-        for x in X:
-            if check_any_null(x):
-                continue
-            if minval is None:
-                minval = x
-                maxval = x
-            elif x < minval:
-                minval = x
-            elif x > maxval:
-                maxval = x
-                
-        if self.has_log_bins:
-            if minval <= 0:
-                self._offset = 1 - minval
-                minval += self._offset
-                maxval += self._offset
-            self.bin_edges = np.logspace(np.log10(minval), 
-                                         np.log10(maxval), 
-                                         self.nbins)
+        self._minval, self._maxval, self._sketches = None, None, None
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y=None):
+        """Update the running minimum and maximum (and quantile sketch)
+        of each column with a chunk of data, then recompute the bin edges
+        from them."""
+        X = np.asarray(safe_get_values(X), dtype=float)
+        self._ndim = X.ndim
+        columns = self._split_columns(X)
+        if self._minval is None:
+            self._minval = [None] * len(columns)
+            self._maxval = [None] * len(columns)
+            self._sketches = [QuantileSketch(self.sketch_size) 
+                              for _ in columns]
+
+        for j, x in enumerate(columns):
+            self._minval[j], self._maxval[j] = _update_range(
+                x, self._minval[j], self._maxval[j])
+            if self.has_quantile_bins:
+                self._sketches[j].update(x)
+
+        self._set_bin_edges()
+        return self
+
+    def merge(self, other):
+        """Combine the state of a Binner fit on other data (with the same
+        parameters and columns) into this one."""
+        for j in xrange(len(self._minval)):
+            self._minval[j], self._maxval[j] = _update_range(
+                [other._minval[j], other._maxval[j]], 
+                self._minval[j], self._maxval[j])
+            self._sketches[j].merge(other._sketches[j])
+
+        self._set_bin_edges()
+        return self
+
+    def _set_bin_edges(self):
+        # edges can't be placed until every column has had a non-null
+        # value, e.g. when the first chunks of a stream are all null
+        if any(minval is None for minval in self._minval):
+            return
+
+        self._edges, self._offsets = [], []
+        for j, (minval, maxval) in enumerate(izip(self._minval, 
+                                                  self._maxval)):
+            offset = 0
+            if self.has_quantile_bins:
+                edges = self._sketches[j].quantiles(
+                    np.linspace(0, 1, self.nbins))
+            elif self.has_log_bins:
+                if minval <= 0:
+                    offset = 1 - minval
+                    minval += offset
+                    maxval += offset
+                edges = np.logspace(np.log10(minval), 
+                                    np.log10(maxval), 
+                                    self.nbins)
+            else:
+                edges = np.linspace(minval, maxval, self.nbins)
+            self._edges.append(edges)
+            self._offsets.append(offset)
+
+        if self._ndim == 1:
+            self.bin_edges, self._offset = self._edges[0], self._offsets[0]
         else:
-            self.bin_edges = np.linspace(minval, maxval, self.nbins)
+            self.bin_edges, self._offset = self._edges, self._offsets
 
     def transform(self, X):
-        X = safe_get_values(X)
-        if self._offset > 0:
-            X = X + self._offset
-        return np.digitize(X, self.bin_edges)
+        X = np.asarray(safe_get_values(X))
+        binned = []
+        for x, edges, offset in izip(self._split_columns(X), self._edges, 
+                                     self._offsets):
+            if offset > 0:
+                x = x + offset
+            binned.append(np.digitize(x, edges))
+
+        if X.ndim == 1:
+            return binned[0]
+        else:
+            return np.column_stack(binned)
 
     def fit_transform(self, X, y=None):
         self.fit(X, y)
         return self.transform(X)
 
+    def _split_columns(self, X):
+        if X.ndim == 1:
+            return [X]
+        else:
+            return [X[:, j] for j in xrange(X.shape[1])]
+
+def _update_range(X, minval, maxval):
+    # running (min, max) of a vector, ignoring nulls
+    X = np.asarray(X, dtype=float)
+    X = X[~np.isnan(X)]
+    if len(X) == 0:
+        return minval, maxval
+
+    lo, hi = X.min(), X.max()
+    if minval is None:
+        return lo, hi
+    else:
+        return min(minval, lo), max(maxval, hi)
+
+class QuantileSketch(object):
+    """
+    Fixed-size, mergeable summary of a stream of numbers, for approximate
+    quantiles without holding or sorting the whole stream.
+
+    The sketch holds at most `size` sorted, weighted points.  Data are
+    added in blocks of `size` values, and whenever more points than that
+    accumulate they are compressed into `size` buckets of equal total
+    weight, each kept as its weighted mean, so no more than 2 * size
+    values are ever sorted at once.  Each compression can shift ranks
+    by up to 1/size of the weight seen so far, and these shifts can
+    add up, so there is no fixed bound on the rank error of a quantile
+    estimate; larger sizes make it smaller.  The exact minimum and
+    maximum are kept.  Sketches of separate chunks or partitions can be
+    combined with merge.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.values = np.empty(0)
+        self.weights = np.empty(0)
+        self.minval = np.nan
+        self.maxval = np.nan
+
+    def update(self, X):
+        """Add the non-null values of X to the sketch."""
+        X = np.asarray(X, dtype=float).ravel()
+        X = X[~np.isnan(X)]
+        if len(X) == 0:
+            return self
+        minval, maxval = X.min(), X.max()
+        for start in xrange(0, len(X), self.size):
+            block = X[start:start + self.size]
+            self._add(block, np.ones(len(block)), minval, maxval)
+        return self
+
+    def merge(self, other):
+        """Add the contents of another sketch to this one."""
+        self._add(other.values, other.weights, other.minval, other.maxval)
+        return self
+
+    def quantiles(self, q):
+        """Estimated values at the quantiles q (in [0, 1])."""
+        total = self.weights.sum()
+        # each point sits at the middle of the rank range it represents
+        ranks = np.cumsum(self.weights) - self.weights / 2.0
+        ranks = np.concatenate([[0], ranks, [total]])
+        values = np.concatenate([[self.minval], self.values, [self.maxval]])
+        return np.interp(np.asarray(q) * total, ranks, values)
+
+    def _add(self, values, weights, minval, maxval):
+        self.minval = np.nanmin([self.minval, minval])
+        self.maxval = np.nanmax([self.maxval, maxval])
+
+        values = np.concatenate([self.values, values])
+        weights = np.concatenate([self.weights, weights])
+        order = np.argsort(values, kind='mergesort')
+        values, weights = values[order], weights[order]
+        if len(values) > self.size:
+            values, weights = self._compress(values, weights)
+        self.values, self.weights = values, weights
+
+    def _compress(self, values, weights):
+        # assign sorted points to buckets by the midpoint of their rank
+        # range, then collapse each bucket to its weighted mean
+        ranks = np.cumsum(weights) - weights / 2.0
+        buckets = (ranks * self.size / weights.sum()).astype(int)
+        buckets = np.minimum(buckets, self.size - 1)
+        bucket_weights = np.bincount(buckets, weights=weights, 
+                                     minlength=self.size)
+        bucket_sums = np.bincount(buckets, weights=values * weights,
+                                  minlength=self.size)
+        used = bucket_weights > 0
+        return bucket_sums[used] / bucket_weights[used], bucket_weights[used]
+
 class ValueCounter(BaseEstimator):
     """Given a matrix X, computes counting statistics using the 
     rows of the matrix as keys.
 
-    For missing or null keys, the global population average is imputed.
+    For missing or null keys, the global population average is imputed,
+    as it is for keys seen fewer than min_count times.
+
+    By default counts are exact, kept in dicts with an entry per key.
+    If sketch_width is given, hits and totals are instead kept in a pair
+    of count-min sketches of sketch_depth rows by sketch_width columns,
+    which take 16 * sketch_depth * sketch_width bytes however many keys
+    there are.  Counts from a sketch are never too low; with probability
+    at least 1 - exp(-sketch_depth), a key's count is overestimated by no
+    more than e * N / sketch_width, N being the number of rows counted.
+    Keys that were never seen may pick up counts from colliding keys, so
+    a min_count above 1 is advisable in this mode.
+
+    If oof_folds is set, fit_transform returns out-of-fold encodings of
+    its training data (see fit_transform_oof), so the counter can sit in
+    a pipeline that is trained and cross validated without leaking the
+    target; transform still uses counts over all of the training data.
     """
-    def __init__(self, target_value=1):
+    def __init__(self, target_value=1, min_count=1, sketch_width=None,
+                 sketch_depth=4, oof_folds=None, oof_random_state=0):
         self.target_value = target_value
+        self.min_count = min_count
+        self.sketch_width = sketch_width
+        self.sketch_depth = sketch_depth
+        self.oof_folds = oof_folds
+        self.oof_random_state = oof_random_state
         self.reset_counts()
         self._columns = None # useful for dict conversions
 
@@ -89,6 +278,13 @@ class ValueCounter(BaseEstimator):
         self.total = defaultdict(float)
         self.all_hits = 0.0
         self.grand_total = 0.0
+        if self.sketch_width is not None:
+            shape = (self.sketch_depth, self.sketch_width)
+            self.hits_sketch = np.zeros(shape)
+            self.total_sketch = np.zeros(shape)
+        else:
+            self.hits_sketch = None
+            self.total_sketch = None
 
     def get_probability(self, key):
         """Input: key for which conditional probability of a hit is to be 
@@ -97,45 +293,214 @@ class ValueCounter(BaseEstimator):
         Output: float.  If key found, return observed conditional probability 
         of hit given the key passed.  Otherwise, return population probability 
         of hit."""
-        if key in self.total:
-            return self.hits.get(key, 0) / float(self.total[key])
-        else:
-            return self.all_hits / float(self.grand_total)
+        return self._key_probabilities([key])[0]
+
+    def _key_probabilities(self, keys):
+        # conditional probability of a hit for each of a list of keys
+        population = self.all_hits / float(self.grand_total)
+        if self.total_sketch is not None:
+            totals, hits = self._sketch_counts(keys)
+            # colliding keys can push the hit estimate over the total
+            hits = np.minimum(hits, totals)
+            counted = totals >= max(self.min_count, 1)
+            probabilities = np.repeat(population, len(keys))
+            probabilities[counted] = hits[counted] / totals[counted]
+            return probabilities
+
+        probabilities = []
+        for key in keys:
+            if key in self.total and self.total[key] >= self.min_count:
+                probabilities.append(
+                    self.hits.get(key, 0) / float(self.total[key]))
+            else:
+                probabilities.append(population)
+        return probabilities
+
+    def _sketch_counts(self, keys):
+        # count-min estimates of the totals and hits of each key
+        buckets = self._sketch_buckets(keys)
+        rows = np.arange(self.sketch_depth)[:, np.newaxis]
+        totals = self.total_sketch[rows, buckets].min(axis=0)
+        hits = self.hits_sketch[rows, buckets].min(axis=0)
+        return totals, hits
+
+    def _sketch_buckets(self, keys):
+        # sketch column of each key in each sketch row, from a
+        # multiply-shift hash of the key's python hash; the hash
+        # parameters depend only on sketch_depth
+        rng = np.random.RandomState(0)
+        a = rng.randint(1, 2**31, size=self.sketch_depth).astype(np.uint64)
+        b = rng.randint(0, 2**31, size=self.sketch_depth).astype(np.uint64)
+        h = np.array([hash(key) for key in keys], dtype=np.int64)
+        h = h.view(np.uint64)
+        mixed = (a[:, np.newaxis] * h + b[:, np.newaxis]) >> np.uint64(32)
+        return (mixed % np.uint64(self.sketch_width)).astype(np.intp)
 
     def fit(self, X, y):
         self.reset_counts()
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y):
+        """Add the counts observed in a chunk of data to the running
+        totals, without discarding what has been seen before."""
         X = safe_get_values(X)
+        is_hit = np.asarray(safe_get_values(y)) == self.target_value
+
+        self.grand_total += len(is_hit)
+        self.all_hits += is_hit.sum()
+
+        # count hits and totals per distinct key in bulk, so the python
+        # level work is one dict update per key rather than per row
+        codes, first = factorize_rows(X)
+        keyed = codes >= 0
+        totals = np.bincount(codes[keyed], minlength=len(first))
+        hits = np.bincount(codes[keyed], weights=is_hit[keyed],
+                           minlength=len(first))
 
         # keeping this variable local because instance method objects
         # can't e pickled
         key_factory = self._get_key_factory(X)
+        if self.total_sketch is not None:
+            keys = [key_factory(X[i]) for i in first]
+            buckets = self._sketch_buckets(keys)
+            for row in xrange(self.sketch_depth):
+                self.total_sketch[row] += np.bincount(
+                    buckets[row], weights=totals, minlength=self.sketch_width)
+                self.hits_sketch[row] += np.bincount(
+                    buckets[row], weights=hits, minlength=self.sketch_width)
+            return self
 
-        for row, value in izip(X, y):
-            hit_count = 1 if value == self.target_value else 0
+        for i, key_total, key_hits in izip(first, totals, hits):
+            key = key_factory(X[i])
+            self.total[key] += key_total
+            self.hits[key] += key_hits
 
-            self.grand_total += 1
-            self.all_hits += hit_count
-            key = key_factory(row)
+        return self
 
-            if not check_any_null(key):
-                self.total[key] += 1
-                self.hits[key] += hit_count
+    def merge(self, other):
+        """Add the counts held by another ValueCounter, e.g. one fit on a
+        different day or partition of the data, to this one.  Both must
+        count the same target value, and sketches must be the same
+        shape."""
+        if other.target_value != self.target_value:
+            raise ValueError('Cannot merge counts of different targets')
+        if ((other.sketch_width, other.sketch_depth) != 
+            (self.sketch_width, self.sketch_depth)):
+            raise ValueError('Cannot merge differently sized sketches')
+
+        self.all_hits += other.all_hits
+        self.grand_total += other.grand_total
+        if self.total_sketch is not None:
+            self.total_sketch += other.total_sketch
+            self.hits_sketch += other.hits_sketch
+        else:
+            for key, key_total in other.total.iteritems():
+                self.total[key] += key_total
+            for key, key_hits in other.hits.iteritems():
+                self.hits[key] += key_hits
+        return self
 
     def transform(self, X):
         X = safe_get_values(X)
 
+        codes, first = factorize_rows(X)
         key_factory = self._get_key_factory(X)
-        result = np.empty(X.shape[0])
-        for i, row in enumerate(X):
-            key = key_factory(row)
-            result[i] = self.get_probability(key)
+        probabilities = list(self._key_probabilities(
+                [key_factory(X[i]) for i in first]))
+        # rows with a null key have code -1, which picks out the
+        # population probability appended at the end
+        if (codes < 0).any():
+            probabilities.append(self.all_hits / float(self.grand_total))
+        else:
+            probabilities.append(np.nan)
 
-        return result
+        return np.asarray(probabilities)[codes]
 
     def fit_transform(self, X, y):
+        if self.oof_folds is not None:
+            return self.fit_transform_oof(X, y, self.oof_folds)
         self.fit(X, y)
         return self.transform(X)
 
+    def fit_transform_oof(self, X, y, folds):
+        """
+        Fit counts on all of X, and return out-of-fold probabilities for
+        X: each row is encoded using only the counts from the other folds,
+        so its own target never leaks into its feature.
+
+        Counts per fold and key are gathered in a single pass, and each
+        fold's encoding is the total minus that fold's counts, rather
+        than a separate refit per fold.
+
+        Parameters:
+        ----------
+        folds: number of folds to assign rows to at random, or an array
+           giving the fold number (0 to n_folds - 1) of each row, or an
+           object with such an array as its fold_ids attribute (e.g. a
+           cv.FoldPlan) covering exactly the rows of X.  At least two
+           folds are needed; otherwise, or if the fold ids don't match
+           the rows of X, ValueError is raised.
+        """
+        if self.total_sketch is not None:
+            raise ValueError('Out-of-fold encoding requires exact counts')
+
+        X = safe_get_values(X)
+        is_hit = np.asarray(safe_get_values(y)) == self.target_value
+        if isinstance(folds, (int, long)):
+            if folds < 2:
+                raise ValueError('At least two folds are needed, got %d' % 
+                                 folds)
+            rng = np.random.RandomState(self.oof_random_state)
+            fold_ids = rng.permutation(len(is_hit)) % folds
+        else:
+            fold_ids = np.asarray(getattr(folds, 'fold_ids', folds), 
+                                  dtype=np.int64)
+            if len(fold_ids) != len(is_hit):
+                raise ValueError('Got fold ids for %d rows, but X has %d' % 
+                                 (len(fold_ids), len(is_hit)))
+            if len(np.unique(fold_ids)) < 2:
+                raise ValueError('At least two distinct folds are needed')
+        n_folds = fold_ids.max() + 1
+
+        codes, first = factorize_rows(X)
+        n_keys = len(first)
+        keyed = codes >= 0
+        key_codes, key_folds = codes[keyed], fold_ids[keyed]
+
+        # counts for every (fold, key) cell in one bincount
+        cells = key_folds * n_keys + key_codes
+        fold_totals = np.bincount(cells, minlength=n_folds * n_keys)
+        fold_totals = fold_totals.reshape((n_folds, n_keys))
+        fold_hits = np.bincount(cells, weights=is_hit[keyed],
+                                minlength=n_folds * n_keys)
+        fold_hits = fold_hits.reshape((n_folds, n_keys))
+        totals, hits = fold_totals.sum(axis=0), fold_hits.sum(axis=0)
+
+        # the fitted state holds the counts over all folds
+        self.reset_counts()
+        self.grand_total = float(len(is_hit))
+        self.all_hits = float(is_hit.sum())
+        key_factory = self._get_key_factory(X)
+        for i, key_total, key_hits in izip(first, totals, hits):
+            key = key_factory(X[i])
+            self.total[key] += key_total
+            self.hits[key] += key_hits
+
+        # population probability excluding each row's own fold
+        fold_rows = np.bincount(fold_ids, minlength=n_folds)
+        fold_all_hits = np.bincount(fold_ids, weights=is_hit, 
+                                    minlength=n_folds)
+        result = ((self.all_hits - fold_all_hits[fold_ids]) / 
+                  (self.grand_total - fold_rows[fold_ids]))
+
+        oof_totals = totals[key_codes] - fold_totals[key_folds, key_codes]
+        oof_hits = hits[key_codes] - fold_hits[key_folds, key_codes]
+        counted = oof_totals >= max(self.min_count, 1)
+        keyed_result = result[keyed]
+        keyed_result[counted] = oof_hits[counted] / oof_totals[counted]
+        result[keyed] = keyed_result
+        return result
+
     def _get_key_factory(self, X):
         if X.ndim == 1:
             return self._identity
@@ -145,10 +510,21 @@ class ValueCounter(BaseEstimator):
     def _identity(self, x):
         return x
 
+def merge_counters(counters):
+    """Combine a sequence of ValueCounters fit on separate partitions of
+    the data (e.g. by parallel workers) into a new ValueCounter holding
+    their summed counts.  The inputs are left unchanged."""
+    counters = list(counters)
+    merged = clone(counters[0])
+    for counter in counters:
+        merged.merge(counter)
+    return merged
+
 def make_binned(extractor, nbins, has_log_bins=False):
     return Pipeline([('extractor', extractor),
                      ('binner', Binner(nbins, has_log_bins))])
 
-def make_probability(extractor, target_value):
+def make_probability(extractor, target_value, oof_folds=None):
     return Pipeline([('extractor', extractor),
-                     ('counter', ValueCounter(target_value))])
+                     ('counter', ValueCounter(target_value, 
+                                              oof_folds=oof_folds))])
@@ -22,125 +22,335 @@
 # indicator matrices from strings, as well as sparse L1-based feature
 # selection.
 
+import re
+from itertools import izip
+
 import numpy as np
+import pandas as pd
 import scipy as sp
 import scipy.sparse
 
 from sklearn.linear_model import Lasso
 from sklearn.base import BaseEstimator
+from sklearn.utils import murmurhash3_32
+
+from ..parallel import run_tasks
 
 class SparseIndicator(BaseEstimator):
     """
     Given an input vector X, where each entry is a delimited string, 
     returns a sparse indicator matrix for each element in the vector.
     
-    Output matrix has rows equal to dimension of X
+    Output matrix has rows equal to dimension of X, and is built directly
+    in CSR format.  A token repeated within one string is counted once
+    per occurrence.
+
+    If n_features is given, tokens are hashed into that many columns
+    instead of being looked up in a learned vocabulary.  No fit pass is
+    needed, memory use is constant, and independent chunks are encoded
+    identically in any process.
     """
-    def __init__(self, delim=','):
+    def __init__(self, delim=',', dtype=np.float64, n_features=None,
+                 alternate_sign=False, max_names=0, n_jobs=1, 
+                 block_size=100000):
         """
         Parameters:
         ----------
         delim: delimiter to use when splitting each element string
+
+        dtype: type of the values in the output matrix
+
+        n_features: if given, number of columns to hash tokens into,
+           using a 32-bit murmurhash of the token
+
+        alternate_sign: in hashing mode, give each token a value of +1
+           or -1 according to its hash, so that collisions tend to
+           cancel out rather than add up
+
+        max_names: in hashing mode, the number of columns for which
+           fitting remembers the first token seen, so that to_name still
+           works for debugging
+
+        n_jobs: number of processes to use in transform; -1 uses every
+           CPU.  The input is split into blocks of block_size rows, each
+           encoded by a worker, and the results stacked.  Workers inherit
+           the fitted vocabulary when the pool starts, rather than being
+           sent it with every block.  Only transform is parallel;
+           fit, partial_fit and fit_transform (and so the training data
+           in a pipeline) are encoded serially.  Inside a cross
+           validation run with n_jobs != 1 the indicator is transformed
+           in a pool worker, which can't start a pool, so it runs
+           serially there too and only the outer n_jobs applies.
         """
         self.delim = delim
+        self.dtype = dtype
+        self.n_features = n_features
+        self.alternate_sign = alternate_sign
+        self.max_names = max_names
+        self.n_jobs = n_jobs
+        self.block_size = block_size
         self.id_lookup = {}
         self.name_lookup = {}
-        self.ncol = 0
+        self.ncol = 0 if n_features is None else n_features
+        self._vocabulary = None
         
     def fit(self, X, y=None):
-        self.id_lookup = {}
-        self.name_lookup = {}
-        self.ncol = 0
-        current_id = 0
-        
-        for i, x in enumerate(X):
-            tokens = x.split(self.delim)
-            for tok in tokens:
-                if tok not in self.id_lookup:
-                    self.id_lookup[tok] = current_id
-                    self.name_lookup[current_id] = tok
-                    current_id += 1
+        self._reset_vocabulary()
+        return self.partial_fit(X, y)
 
-        self.ncol = current_id
+    def partial_fit(self, X, y=None):
+        """
+        Extend the vocabulary with any tokens in X not seen so far.
+        Existing tokens keep their column ids.  In hashing mode, only
+        records names for to_name.
+        """
+        rows, tokens = self._tokenize(X)
+        if self.n_features is not None:
+            self._hash_tokens(tokens, remember_names=True)
+        else:
+            self._extend_vocabulary(tokens)
         return self
 
     def transform(self, X):
-        rows = []
-        cols = []
-        vals = []
-
-        for i, x in enumerate(X):
-            tokens = x.split(self.delim)
-            for tok in tokens:
-                if tok in self.id_lookup:
-                    rows.append(i)
-                    cols.append(self.id_lookup[tok])
-                    vals.append(1)
-
-        nrow = X.shape[0]
-        return sp.sparse.coo_matrix(
-            (np.array(vals, dtype='float64'), (rows, cols)),
-            shape=(nrow, self.ncol))
+        if self.n_jobs != 1 and len(X) > self.block_size:
+            return self._parallel_transform(X)
+
+        rows, tokens = self._tokenize(X)
+        if self.n_features is not None:
+            cols, values = self._hash_tokens(tokens)
+            return self._build_matrix(rows, cols, len(X), values)
+
+        cols = self._get_vocabulary().get_indexer(tokens)
+        known = cols >= 0
+        return self._build_matrix(rows[known], cols[known], len(X))
 
     def fit_transform(self, X, y=None):
+        self._reset_vocabulary()
+        rows, tokens = self._tokenize(X)
+        if self.n_features is not None:
+            cols, values = self._hash_tokens(tokens, remember_names=True)
+            return self._build_matrix(rows, cols, len(X), values)
+
+        self._extend_vocabulary(tokens)
+        cols = self._get_vocabulary().get_indexer(tokens)
+        return self._build_matrix(rows, cols, len(X))
+
+    def _parallel_transform(self, X):
+        X = np.asarray(X, dtype=object)
+        if self.n_features is None:
+            # build the lookup index before the workers fork
+            self._get_vocabulary()
+        blocks = [(start, min(start + self.block_size, len(X)))
+                  for start in xrange(0, len(X), self.block_size)]
+        shared = {'indicator': self, 'X': X}
+        results = run_tasks(_transform_block, blocks, shared, self.n_jobs)
+        return sp.sparse.vstack(results, format='csr')
+
+    def _hash_tokens(self, tokens, remember_names=False):
+        # Column and value of each token in hashing mode.  Each distinct
+        # token is hashed once.
+        codes, uniques = pd.factorize(tokens)
+        hashes = np.array([murmurhash3_32(tok) for tok in uniques], 
+                          dtype=np.int64)
+        cols = np.abs(hashes) % self.n_features
+        if self.alternate_sign:
+            signs = np.where(hashes >= 0, 1, -1)
+        else:
+            signs = np.ones(len(hashes))
+
+        if remember_names:
+            for tok, col in izip(uniques, cols):
+                if len(self.name_lookup) >= self.max_names:
+                    break
+                self.name_lookup.setdefault(col, tok)
+
+        return cols[codes], signs[codes]
+
+    def _tokenize(self, X):
+        # Split all strings in X at once: join them with the delimiter
+        # and split the result, then recover each token's row from the
+        # number of delimiters in each string.  This still builds a flat
+        # list of every token (and the joined string) as Python objects,
+        # though no per-row lists; pandas of the vintage this targets
+        # has no explode to do the split inside pandas.
+        X = pd.Series(np.asarray(X, dtype=object))
+        if len(X) == 0:
+            # ''.split(delim) would give one empty token
+            return np.empty(0, dtype=int), np.empty(0, dtype=object)
+        counts = X.str.count(re.escape(self.delim)).values.astype(int) + 1
+        rows = np.repeat(np.arange(len(X)), counts)
+        tokens = np.array(self.delim.join(X.values).split(self.delim),
+                          dtype=object)
+        return rows, tokens
+
+    def _extend_vocabulary(self, tokens):
+        # new tokens get the next column ids, in order of first appearance
+        current_id = self.ncol
+        for tok in pd.unique(tokens):
+            if tok not in self.id_lookup:
+                self.id_lookup[tok] = current_id
+                self.name_lookup[current_id] = tok
+                current_id += 1
+
+        if current_id != self.ncol:
+            self._vocabulary = None
+        self.ncol = current_id
+
+    def _get_vocabulary(self):
+        # index of tokens in column order, for bulk token -> column lookup
+        if self._vocabulary is None:
+            self._vocabulary = pd.Index(
+                [self.name_lookup[i] for i in xrange(self.ncol)], 
+                dtype=object)
+        return self._vocabulary
+
+    def _reset_vocabulary(self):
         self.id_lookup = {}
         self.name_lookup = {}
-        self.ncol = 0
-        current_id = 0
-        rows = []
-        cols = []
-        vals = []
-
-        for i, x in enumerate(X):
-            tokens = x.split(self.delim)
-            for tok in tokens:
-                if tok not in self.id_lookup:
-                    self.id_lookup[tok] = current_id
-                    self.name_lookup[current_id] = tok
-                    current_id += 1
-                rows.append(i)
-                cols.append(self.id_lookup[tok])
-                vals.append(1)
-
-        nrow = X.shape[0]
-        self.ncol = current_id
-        return sp.sparse.coo_matrix(
-            (np.array(vals, dtype='float64'), (rows, cols)),
-            shape=(nrow, self.ncol))
+        self.ncol = 0 if self.n_features is None else self.n_features
+        self._vocabulary = None
+
+    def _build_matrix(self, rows, cols, nrow, values=None):
+        # rows come out of _tokenize in order, so CSR row pointers are
+        # just cumulative row counts
+        row_counts = np.bincount(rows, minlength=nrow)
+        indptr = np.concatenate([[0], np.cumsum(row_counts)])
+        if values is None:
+            values = np.ones(len(cols), dtype=self.dtype)
+        # in hashing mode the width comes from n_features as it is now,
+        # which set_params may have changed since ncol was set
+        ncol = self.ncol if self.n_features is None else self.n_features
+        return sp.sparse.csr_matrix(
+            (np.asarray(values, dtype=self.dtype), 
+             cols.astype(np.int32), indptr.astype(np.int32)),
+            shape=(nrow, ncol))
 
     def to_name(self, X, default=None):
         try:
             return [self.name_lookup.get(x, default) for x in X]
         except TypeError:
             # catch situation where X is not iterable
-            return self.name_lookup.get(x, default)
+            return self.name_lookup.get(X, default)
+
+def _transform_block(shared, start, stop):
+    # encode one block of rows in a worker, with the parallel path
+    # switched off so that the worker doesn't start a pool of its own
+    indicator = shared['indicator']
+    n_jobs, indicator.n_jobs = indicator.n_jobs, 1
+    try:
+        return indicator.transform(shared['X'][start:stop])
+    finally:
+        indicator.n_jobs = n_jobs
 
 class SparseSelector(BaseEstimator):
     """
     Sparse L1 based feature selection.  Parameters are passed onto
     sklearn.linear_model.Lasso, which actually does the work.
+
+    If n_features is given, alpha is ignored.  Instead a warm-started
+    Lasso path is followed down from the smallest alpha that selects
+    nothing, over n_alphas values to alpha_min_ratio times that, until
+    at least n_features columns are selected; the n_features columns
+    with the largest coefficients are kept.  At each step of the path,
+    columns that the sequential strong rule marks as clearly irrelevant
+    (low correlation with the current residual) are left out of the
+    solve, and any that then violate the optimality conditions are added
+    back.  Screening is skipped when normalize is set.
+
+    The selected column indices are cached at fit time as columns_.
     """
     def __init__(self, alpha=1.0, fit_intercept=True, 
-                 normalize=False):
+                 normalize=False, n_features=None, n_alphas=30,
+                 alpha_min_ratio=1e-3):
         self.alpha = alpha
         self.fit_intercept = fit_intercept
         self.normalize = normalize
+        self.n_features = n_features
+        self.n_alphas = n_alphas
+        self.alpha_min_ratio = alpha_min_ratio
         self.lasso = None
+        self.coef_ = None
+        self.columns_ = None
 
     def fit(self, X, y):
-        self.lasso = Lasso(alpha=self.alpha, 
-                           fit_intercept=self.fit_intercept,
-                           normalize=self.normalize)
-        self.lasso.fit(X, y)
+        if self.n_features is None:
+            self.lasso = Lasso(alpha=self.alpha, 
+                               fit_intercept=self.fit_intercept,
+                               normalize=self.normalize)
+            self.lasso.fit(X, y)
+            self.coef_ = self.lasso.coef_
+            self.columns_ = np.flatnonzero(self.coef_)
+        else:
+            self.coef_ = self._fit_path(X, y)
+            ranked = np.argsort(-np.abs(self.coef_), kind='mergesort')
+            ranked = ranked[:np.count_nonzero(self.coef_)]
+            self.columns_ = np.sort(ranked[:self.n_features])
+
+        # gathering columns by multiplying with a 0/1 selection matrix
+        # works on any sparse format without converting it first
+        ncol = len(self.columns_)
+        self._selection = sp.sparse.csr_matrix(
+            (np.ones(ncol), (self.columns_, np.arange(ncol))),
+            shape=(X.shape[1], ncol))
         return self
         
     def transform(self, X):
-        cols = np.nonzero(self.lasso.sparse_coef_)[1]
         if sp.sparse.issparse(X):
-            return X.tocsc()[:, cols]
+            # match the input's dtype, so that e.g. float32 output from
+            # SparseIndicator isn't upcast to float64
+            selection = self._selection
+            if selection.dtype != X.dtype:
+                selection = selection.astype(X.dtype)
+            return X * selection
         else:
-            return X[:, cols]
+            return X[:, self.columns_]
 
     def fit_transform(self, X, y):
         self.fit(X, y)
         return self.transform(X)
+
+    def _fit_path(self, X, y):
+        # Follow the Lasso path with strong-rule screening until at least
+        # n_features coefficients are nonzero; returns the coefficients.
+        if sp.sparse.issparse(X):
+            X = sp.sparse.csc_matrix(X)
+        y = np.asarray(y, dtype=np.float64)
+        n, p = X.shape
+        residual = y - y.mean() if self.fit_intercept else y
+
+        alpha_max = np.abs(X.T.dot(residual)).max() / n
+        alphas = alpha_max * np.logspace(0, np.log10(self.alpha_min_ratio),
+                                         self.n_alphas)
+        coef = np.zeros(p)
+        prev_alpha = alpha_max
+        for alpha in alphas[1:]:
+            grad = np.abs(X.T.dot(residual)) / n
+            if self.normalize:
+                keep = np.ones(p, dtype=bool)
+            else:
+                keep = (grad >= 2 * alpha - prev_alpha) | (coef != 0)
+
+            while True:
+                cols = np.flatnonzero(keep)
+                lasso = Lasso(alpha=alpha, fit_intercept=self.fit_intercept,
+                              normalize=self.normalize, warm_start=True)
+                lasso.coef_ = coef[cols]
+                lasso.fit(X[:, cols], y)
+                coef = np.zeros(p)
+                coef[cols] = lasso.coef_
+                residual = y - X.dot(coef) - lasso.intercept_
+
+                # add back screened out columns that break the KKT
+                # conditions, and solve again
+                grad = np.abs(X.T.dot(residual)) / n
+                violated = ~keep & (grad > alpha)
+                if not violated.any():
+                    break
+                keep |= violated
+
+            prev_alpha = alpha
+            self.alpha_ = alpha
+            if np.count_nonzero(coef) >= self.n_features:
+                break
+
+        return coef
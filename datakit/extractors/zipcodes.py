@@ -18,15 +18,20 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
 import re
-from collections import defaultdict
+import tempfile
 from itertools import izip
-from math import degrees, radians, sin, cos, acos
 
 import numpy as np
 import pandas as pd
 
-from ..util import is_number, safe_get_values, check_any_null
+from sklearn.neighbors import BallTree
+
+from ..util import is_number, safe_get_values, factorize_rows, LRUCache
+
+# statute miles per degree of great circle arc
+MILES_PER_DEGREE = 69.09
 
 def normalize_string(s):
     # strip whitespace and dashes, convert to uppercase
@@ -35,31 +40,135 @@ def normalize_string(s):
     s = s.upper()
     return s
 
-class PostMapperBase(object):
+class SharedTable(object):
+    """
+    Mixin for objects holding their data in a structured array, table,
+    that can be saved to a .npy file and memory-mapped from there by
+    attach.  Once attached, the object is pickled without the table and
+    its views (the _table_attrs) and reattaches to the file when
+    unpickled.  _transient_attrs are never pickled, being rebuilt on
+    demand.  Subclasses implement set_table.
+    """
+    _table_attrs = ('table', 'codes', 'lat', 'lng')
+    _transient_attrs = ()
+
+    def attach(self, path):
+        """Use the table saved at path by share, read-only."""
+        self.set_table(np.load(path, mmap_mode='r'))
+        self.shared_path = path
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._transient_attrs:
+            state[attr] = None
+        if self.shared_path:
+            for attr in self._table_attrs:
+                state[attr] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_path:
+            self.attach(self.shared_path)
+
+class PostMapperBase(SharedTable):
     """Handles file I/O and defines the basic interface for any
-    postcode mapper objects."""
-    def __init__(self, csvfile, code_col, lat_col, lng_col):
+    postcode mapper objects.
+
+    init_cache loads the csv file into a table of normalized codes and
+    coordinates, sorted by code (the codes, lat and lng arrays), from
+    which the code_map dict is built on first use.  If cache_file is
+    given, the table is saved there as a .npy file and memory-mapped by
+    later calls, in this or any other process, for as long as it is
+    newer than the csv file.
+
+    share and attach let processes use one read-only copy of the table;
+    see share.
+    """
+    # code_map is rebuilt on first use
+    _transient_attrs = ('_code_map',)
+
+    def __init__(self, csvfile, code_col, lat_col, lng_col, cache_file=None):
         self.csvfile = csvfile
         self.code_col = code_col
         self.lat_col = lat_col
         self.lng_col = lng_col
-        self.code_map = {}
+        self.cache_file = cache_file
+        self.shared_path = None
+        self.table = None
+        self.codes = None
+        self.lat = None
+        self.lng = None
+        self._code_map = None
     
     def init_cache(self):
-        self.code_map = {}
+        if self.shared_path:
+            table = np.load(self.shared_path, mmap_mode='r')
+        elif self.cache_file and _is_newer(self.cache_file, self.csvfile):
+            table = np.load(self.cache_file, mmap_mode='r')
+        else:
+            table = self.load_table()
+            if self.cache_file:
+                _save_table(self.cache_file, table)
+        self.set_table(table)
+
+    def share(self, path):
+        """
+        Save the table loaded by init_cache to path, a .npy file, and
+        memory-map it from there.  Processes mapping the same file share
+        its pages.  Once shared, the mapper is pickled without its table
+        and attaches to path when unpickled (e.g. in a worker process),
+        without reading the csv file again.
+        """
+        _save_table(path, self.table)
+        self.attach(path)
+
+    @property
+    def code_map(self):
+        # dict of normalized code -> (lat, lng), for lookups of single
+        # codes; built from the table when first needed, so that
+        # processes using only the arrays never hold a copy
+        if self._code_map is None:
+            if self.codes is None:
+                return {}
+            self._code_map = dict(izip(self.codes.tolist(), 
+                                       izip(self.lat.tolist(), 
+                                            self.lng.tolist())))
+        return self._code_map
+
+    def load_table(self):
+        """Read the csv file into a structured array with fields code,
+        lat and lng, one row per normalized code, sorted by code."""
         converters = {self.code_col: str} # store postcodes as strings
         df = pd.read_csv(self.csvfile, 
                          usecols=[self.code_col, self.lat_col, self.lng_col],
                          converters=converters)
-        for _, row in df.iterrows():
-            code = row[self.code_col]
-            if code:
-                norm_code = self.normalize(code)
-                coords = (row[self.lat_col], row[self.lng_col])
-                self.add_code(norm_code, coords)
+        df = df[df[self.code_col].str.len() > 0]
+        codes = _encode_codes(self.normalize_series(df[self.code_col]))
+        lat = df[self.lat_col].values.astype(float)
+        lng = df[self.lng_col].values.astype(float)
+        codes, lat, lng = self.aggregate(codes, lat, lng)
+
+        table = np.empty(len(codes), dtype=[('code', codes.dtype), 
+                                            ('lat', float), ('lng', float)])
+        table['code'] = codes
+        table['lat'] = lat
+        table['lng'] = lng
+        return table
+
+    def set_table(self, table):
+        self.table = table
+        self.codes = table['code']
+        self.lat = table['lat']
+        self.lng = table['lng']
+        self._code_map = None
 
-    def add_code(self, norm_code, coords):
-        self.code_map[norm_code] = coords
+    def aggregate(self, codes, lat, lng):
+        # one row per distinct code, sorted by code; a later row for a
+        # code replaces any earlier ones
+        uniques, last = np.unique(codes[::-1], return_index=True)
+        last = len(codes) - 1 - last
+        return uniques, lat[last], lng[last]
 
     def lookup(self, code):
         raise NotImplementedError()
@@ -67,6 +176,16 @@ class PostMapperBase(object):
     def normalize(self, code):
         raise NotImplementedError()
 
+    def normalize_series(self, codes):
+        """Normalize a Series of codes; subclasses should override this
+        with pandas string operations matching normalize."""
+        return codes.map(self.normalize)
+
+    def lookup_keys(self, codes):
+        """Keys into the table for a Series of codes, as used by lookup,
+        or null where lookup would fail without consulting the table."""
+        return self.normalize_series(codes)
+
 class AreaPostMapper(PostMapperBase):
     """
     Used where there is not a one-to-one correspondence between
@@ -74,20 +193,15 @@ class AreaPostMapper(PostMapperBase):
     the derived value is the average of matching postcodes, of which
     there may be many.
     """
-    def init_cache(self):
-        # this is perhaps a bit kludgy
-        self._counts = defaultdict(float)
-        super(AreaPostMapper, self).init_cache()
-
-    def add_code(self, norm_code, coords):
-        lat, lng = coords
-        if not (pd.isnull(lat) or pd.isnull(lng)):
-            N = self._counts[norm_code]
-            old_lat, old_lng = self.code_map.get(norm_code, (0, 0))
-            new_lat = (N*old_lat + lat) / (N + 1.0)
-            new_lng = (N*old_lng + lng) / (N + 1.0)
-            self.code_map[norm_code] = (new_lat, new_lng)
-            self._counts[norm_code] += 1.0
+    def aggregate(self, codes, lat, lng):
+        # average over the rows with known coordinates
+        known = ~(np.isnan(lat) | np.isnan(lng))
+        codes, lat, lng = codes[known], lat[known], lng[known]
+        uniques, inverse = np.unique(codes, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(uniques))
+        lat = np.bincount(inverse, lat, minlength=len(uniques)) / counts
+        lng = np.bincount(inverse, lng, minlength=len(uniques)) / counts
+        return uniques, lat, lng
     
     def lookup(self, code):
         norm_code = self.normalize(code)
@@ -106,6 +220,14 @@ class USPostMapper(PostMapperBase):
         code = normalize_string(code)
         return code
 
+    def normalize_series(self, codes):
+        return codes.str.replace(' ', '').str.replace('-', '').str.upper()
+
+    def lookup_keys(self, codes):
+        keys = self.normalize_series(codes)
+        numeric = keys.map(is_number).astype(bool)
+        return keys.str.slice(0, 5).where(numeric)
+
 class UKPostMapper(AreaPostMapper):
     def normalize(self, code):
         tokens = code.split()
@@ -114,48 +236,169 @@ class UKPostMapper(AreaPostMapper):
         else:
             return ''
 
+    def normalize_series(self, codes):
+        # first whitespace-separated token
+        codes = codes.str.replace(r'^\s+', '').str.replace(r'\s.*$', '')
+        return codes.str.upper()
+
 class CanadaPostMapper(AreaPostMapper):
     def normalize(self, code):
         return code.upper()[:3]
 
+    def normalize_series(self, codes):
+        return codes.str.upper().str.slice(0, 3)
+
+class PostcodeIndex(SharedTable):
+    """
+    Coordinates of postcodes from several mappers, held as arrays: the
+    mappers' sorted code tables concatenated in priority order, with
+    parallel lat and lng arrays.  lookup_many resolves a whole column of
+    codes at once, each code taking its coordinates from the first
+    mapper that knows it, as DistanceCalculator did code by code.  The
+    mappers must have been initialized with init_cache.
+    """
+    def __init__(self, mappers):
+        self.mappers = mappers
+        self.shared_path = None
+        sizes = [len(mapper.codes) for mapper in mappers]
+        self.offsets = np.cumsum([0] + sizes)
+        codes = np.concatenate([np.array([], dtype=str)] + 
+                               [mapper.codes for mapper in mappers])
+
+        # one extra row, with NaN coordinates, for unresolved codes 
+        # (row -1)
+        table = np.empty(len(codes) + 1, dtype=[('code', codes.dtype),
+                                                ('lat', float), 
+                                                ('lng', float)])
+        table['code'][:-1] = codes
+        table['code'][-1] = ''
+        table['lat'] = np.concatenate([mapper.lat for mapper in mappers] + 
+                                      [[np.nan]])
+        table['lng'] = np.concatenate([mapper.lng for mapper in mappers] + 
+                                      [[np.nan]])
+        self.set_table(table)
+
+    def set_table(self, table):
+        self.table = table
+        self.codes = table['code'][:-1]
+        self.lat = table['lat']
+        self.lng = table['lng']
+
+    def share(self, prefix):
+        """
+        Save the tables of the index and its mappers to .npy files
+        named after prefix (prefix.index.npy, and prefix.0.npy etc. in
+        mapper order) and memory-map them from there; see
+        PostMapperBase.share.  The index is then pickled without its
+        table, and attaches to the files when unpickled.
+        """
+        for i, mapper in enumerate(self.mappers):
+            mapper.share('%s.%d.npy' % (prefix, i))
+        path = '%s.index.npy' % prefix
+        _save_table(path, self.table)
+        self.attach(path)
+
+    def lookup_many(self, codes):
+        """Return arrays of latitude and longitude for an array or
+        Series of codes, NaN for null or unknown codes."""
+        rows = self.lookup_rows(codes)
+        return self.lat[rows], self.lng[rows]
+
+    def lookup_rows(self, codes):
+        """Return the row of the index for each of an array or Series
+        of codes, -1 for null or unknown codes."""
+        ids, uniques = pd.factorize(np.asarray(codes, dtype=object))
+        rows = self.find_rows(pd.Series(uniques))
+        # append a -1 row for null codes (id -1)
+        return np.append(rows, -1)[ids]
+
+    def find_rows(self, codes):
+        """Row of the index holding each code of a Series, or -1."""
+        rows = np.empty(len(codes), dtype=np.int64)
+        rows.fill(-1)
+        bounds = izip(self.offsets[:-1], self.offsets[1:])
+        for mapper, (start, stop) in izip(self.mappers, bounds):
+            todo = np.flatnonzero(rows < 0)
+            if len(todo) == 0 or start == stop:
+                continue
+            keys = mapper.lookup_keys(codes.take(todo))
+            valid = keys.notnull().values
+            keys = _encode_codes(keys[valid])
+            table = self.codes[start:stop]
+            pos = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+            hit = table[pos] == keys
+            rows[todo[valid][hit]] = start + pos[hit]
+        return rows
+
 class DistanceCalculator(object):
     """
     Given a dataframe X, having two columns, each being a postcode,
     calculate the distance between those post codes in miles.
+
+    Each distinct pair of codes in X is looked up and computed once.  If
+    cache_size is positive, distances of up to that many pairs are also
+    remembered across calls to transform (e.g. across cross validation
+    folds), least recently used pairs being dropped first.
     """
-    def __init__(self, mappers, bin_function=None):
+    def __init__(self, mappers, bin_function=None, cache_size=0):
         self.mappers = mappers
+        self.cache_size = cache_size
         # initialize mappers once - save time curing cross validation
         # folds
         self._initialized = False
+        self._index = None
+        self._pair_cache = LRUCache(cache_size)
         
     def fit(self, X, y=None):
         if not self._initialized:
             for mapper in self.mappers:
                 mapper.init_cache()
+            self._index = PostcodeIndex(self.mappers)
+            # drop any NaN distances cached before the tables were loaded
+            self._pair_cache = LRUCache(self.cache_size)
             self._initialized = True
+        return self
+
+    def partial_fit(self, X, y=None):
+        # distances depend only on the postcode tables, so there is
+        # no running state to update beyond loading them once
+        return self.fit(X, y)
 
     def transform(self, X):
         X = safe_get_values(X)
 
-        result = np.empty(X.shape[0])
-        for i, row in enumerate(X):
-            if check_any_null(row):
-                result[i] = np.nan
-            else:
-                code_a, code_b = row
-                coord_a = self._get_coordinate(code_a)
-                coord_b = self._get_coordinate(code_b)
-                if check_any_null((coord_a, coord_b)):
-                    result[i] = np.nan
-                else:
-                    result[i] = self._calc_dist(coord_a, coord_b)
-        return result
+        # work on distinct pairs only; rows with a null code get -1,
+        # which picks out the NaN appended after the pair distances
+        codes, first = factorize_rows(X)
+        pairs = X[first]
+        distances = np.empty(len(first) + 1)
+        distances[-1] = np.nan
+
+        if self.cache_size > 0:
+            cached = [self._pair_cache.get(tuple(pair)) for pair in pairs]
+            todo = np.array([d is None for d in cached], dtype=bool)
+            distances[:-1][~todo] = [d for d in cached if d is not None]
+        else:
+            todo = np.ones(len(first), dtype=bool)
+
+        distances[:-1][todo] = self._pair_distances(pairs[todo])
+        if self.cache_size > 0:
+            for pair, dist in izip(pairs[todo], distances[:-1][todo]):
+                self._pair_cache.put(tuple(pair), dist)
+
+        return distances[codes]
 
     def fit_transform(self, X, y=None):
         self.fit(X)
         return self.transform(X)
 
+    def share(self, prefix):
+        """Publish the postcode tables loaded by fit as memory-mapped
+        files named after prefix (see PostcodeIndex.share), so that
+        copies of this calculator pickled to other processes attach to
+        them instead of carrying their own."""
+        self._index.share(prefix)
+
     def _get_coordinate(self, code):
         for mapper in self.mappers:
             coord = mapper.lookup(code)
@@ -163,19 +406,252 @@ class DistanceCalculator(object):
                 return coord
         return None
 
+    def _pair_distances(self, pairs):
+        lat_a, lng_a = self._get_coordinates(pairs[:, 0])
+        lat_b, lng_b = self._get_coordinates(pairs[:, 1])
+        # unknown codes have NaN coordinates, and so NaN distance
+        return haversine(lat_a, lng_a, lat_b, lng_b)
+
+    def _get_coordinates(self, codes):
+        # latitude and longitude arrays for a column of codes; all
+        # unknown (NaN) before the mappers are loaded by fit
+        if self._index is None:
+            lat = np.empty(len(codes))
+            lat.fill(np.nan)
+            return lat, lat.copy()
+        return self._index.lookup_many(codes)
+
     def _calc_dist(self, a, b):
         # calculate the distance in statute miles based on coordinates
         lat_a, long_a = a
         lat_b, long_b = b
-        
-        lat_a = radians(lat_a)
-        lat_b = radians(lat_b)
-        long_diff = radians(long_a - long_b)
-        distance = (sin(lat_a) * sin(lat_b) +
-                    cos(lat_a) * cos(lat_b) * cos(long_diff))
-        try:
-            dist = degrees(acos(distance)) * 69.09 # magic number?
-        except ValueError:
-            dist = np.nan
-            #print distance, lat_a, long_a, lat_b, long_b
-        return dist
+        return float(haversine(lat_a, long_a, lat_b, long_b))
+
+class SpatialIndex(object):
+    """
+    Ball tree over points given by latitude and longitude, answering
+    batched radius and nearest neighbor queries in miles.  Points are
+    mapped to unit vectors, where straight line (chord) distance grows
+    with great circle distance, so a euclidean tree can be used.
+
+    weights, if given, are summed over the points within the radius in
+    place of counting them.
+    """
+    def __init__(self, lat, lng, weights=None, leaf_size=30):
+        self.weights = weights
+        self.n_points = len(lat)
+        if self.n_points > 0:
+            self.tree = BallTree(_unit_vectors(lat, lng), leaf_size=leaf_size)
+        else:
+            self.tree = None
+
+    def count_within(self, lat, lng, radius):
+        """Number (or total weight) of points within radius miles of
+        each query point."""
+        if self.tree is None or len(lat) == 0:
+            return np.zeros(len(lat))
+        X = _unit_vectors(lat, lng)
+        chord = _miles_to_chord(radius)
+        if self.weights is None:
+            return self.tree.query_radius(X, chord, count_only=True) * 1.0
+        neighbors = self.tree.query_radius(X, chord)
+        return np.array([self.weights[ind].sum() for ind in neighbors],
+                        dtype=float)
+
+    def query(self, lat, lng, k=1):
+        """Distances in miles to, and indices of, the k nearest points
+        to each query point, nearest first."""
+        X = _unit_vectors(lat, lng)
+        chord, ind = self.tree.query(X, k=k)
+        return _chord_to_miles(chord), ind
+
+class PostcodeNeighbors(object):
+    """
+    Given a dataframe X with one column of postcodes, return two
+    features for each row:
+    - the number of rows of the data seen by fit (or partial_fit) whose
+      postcode lies within radius miles of the row's postcode
+    - the distance in miles to the n_neighbors-th nearest other postcode
+      known to the mappers (NaN if there are no more than n_neighbors
+      postcodes)
+    Both are NaN for null or unknown postcodes, and for every row if the
+    extractor hasn't been fit.  Queries are answered by SpatialIndex,
+    once per distinct postcode; the tree of users is built by the first
+    transform after fitting, so partial_fit only updates counts.
+    """
+    def __init__(self, mappers, radius=10.0, n_neighbors=1):
+        self.mappers = mappers
+        self.radius = radius
+        self.n_neighbors = n_neighbors
+        # as with DistanceCalculator, initialize mappers and the postcode
+        # tree once (the tree when first needed), and only recount users
+        # on each fit
+        self._initialized = False
+        self._index = None
+        self._postcodes = None
+        self._user_counts = None
+        self._users = None
+        self._located = None
+
+    def fit(self, X, y=None):
+        self._initialize()
+        self._user_counts = np.zeros(len(self._index.codes))
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y=None):
+        self._initialize()
+        if self._user_counts is None:
+            self._user_counts = np.zeros(len(self._index.codes))
+        rows = self._index.lookup_rows(self._get_codes(X))
+        rows = rows[rows >= 0]
+        self._user_counts += np.bincount(rows, 
+                                         minlength=len(self._index.codes))
+        # the user tree is rebuilt by the next transform, not per chunk
+        self._users = None
+        return self
+
+    def transform(self, X):
+        codes = self._get_codes(X)
+        if self._user_counts is None:
+            # not fit: every postcode is unknown
+            features = np.empty((len(codes), 2))
+            features.fill(np.nan)
+            return features
+
+        rows = self._index.lookup_rows(codes)
+        uniques, inverse = np.unique(rows, return_inverse=True)
+        known = self._get_located()[uniques]
+        lat = self._index.lat[uniques[known]]
+        lng = self._index.lng[uniques[known]]
+
+        features = np.empty((len(uniques), 2))
+        features.fill(np.nan)
+        features[known, 0] = self._get_users().count_within(lat, lng, 
+                                                             self.radius)
+        # the nearest point to a known postcode is the postcode itself;
+        # with too few postcodes there is no n_neighbors-th other one,
+        # and the distance is left as NaN
+        postcodes = self._get_postcodes()
+        k = self.n_neighbors + 1
+        if k <= postcodes.n_points and known.any():
+            dist, _ = postcodes.query(lat, lng, k=k)
+            features[known, 1] = dist[:, -1]
+        return features[inverse]
+
+    def fit_transform(self, X, y=None):
+        self.fit(X)
+        return self.transform(X)
+
+    def share(self, prefix):
+        """Publish the postcode tables as memory-mapped files named
+        after prefix; see DistanceCalculator.share.  Pickled copies then
+        also leave out the tree of postcodes, which they rebuild from
+        the shared tables when first needed."""
+        self._initialize()
+        self._index.share(prefix)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._index is not None and self._index.shared_path:
+            state['_postcodes'] = None
+            state['_located'] = None
+        return state
+
+    def _initialize(self):
+        if not self._initialized:
+            for mapper in self.mappers:
+                mapper.init_cache()
+            self._index = PostcodeIndex(self.mappers)
+            self._initialized = True
+
+    def _get_located(self):
+        # True for index rows with coordinates; the last entry is for
+        # unknown codes (row -1)
+        if self._located is None:
+            self._located = ~(np.isnan(self._index.lat) | 
+                              np.isnan(self._index.lng))
+        return self._located
+
+    def _get_postcodes(self):
+        # tree of every postcode with coordinates
+        if self._postcodes is None:
+            located = self._get_located()[:-1]
+            self._postcodes = SpatialIndex(self._index.lat[:-1][located],
+                                           self._index.lng[:-1][located])
+        return self._postcodes
+
+    def _get_users(self):
+        # tree of the postcodes of the rows seen by fit, weighted by
+        # their number of rows; the base mapper may keep codes without
+        # coordinates, which are left out
+        if self._users is None:
+            located = self._get_located()[:-1]
+            users = np.flatnonzero(self._user_counts * located)
+            self._users = SpatialIndex(self._index.lat[users], 
+                                       self._index.lng[users],
+                                       weights=self._user_counts[users])
+        return self._users
+
+    def _get_codes(self, X):
+        X = safe_get_values(X)
+        if X.ndim > 1:
+            X = X[:, 0]
+        return X
+
+def haversine(lat_a, lng_a, lat_b, lng_b):
+    """
+    Great circle distance in statute miles between points given by
+    latitude and longitude in degrees; arguments may be arrays.  Uses the
+    haversine formula, which stays accurate for nearby points, where
+    the spherical law of cosines loses precision (or, through rounding,
+    strays outside the domain of acos).
+    """
+    lat_a, lng_a, lat_b, lng_b = [np.radians(np.asarray(v, dtype=float))
+                                  for v in (lat_a, lng_a, lat_b, lng_b)]
+    h = (np.sin((lat_b - lat_a) / 2) ** 2 + 
+         np.cos(lat_a) * np.cos(lat_b) * np.sin((lng_b - lng_a) / 2) ** 2)
+    arc = 2 * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+    return np.degrees(arc) * MILES_PER_DEGREE
+
+def _encode_codes(codes):
+    # Array of byte strings from a sequence of codes.  unicode codes are
+    # UTF-8 encoded explicitly: numpy's conversion to str would fail on
+    # non-ASCII ones.
+    return np.array([code.encode('utf-8') if isinstance(code, unicode) 
+                     else code for code in codes], dtype=str)
+
+def _save_table(path, table):
+    # Write to exactly path (np.save would add .npy to a bare name).  The
+    # table goes to a temporary file in the same directory, renamed into
+    # place once complete, so that no process maps a partly written
+    # file, and a file already mapped by this or another process is
+    # replaced rather than truncated under its mappings.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, table)
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _is_newer(path, other):
+    # True if path exists and was modified no earlier than other
+    return (os.path.exists(path) and 
+            os.path.getmtime(path) >= os.path.getmtime(other))
+
+def _unit_vectors(lat, lng):
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lng = np.radians(np.asarray(lng, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lng),
+                            np.cos(lat) * np.sin(lng),
+                            np.sin(lat)])
+
+def _miles_to_chord(miles):
+    arc = np.radians(np.minimum(miles / MILES_PER_DEGREE, 180.0))
+    return 2 * np.sin(arc / 2)
+
+def _chord_to_miles(chord):
+    arc = 2 * np.arcsin(np.clip(chord / 2, 0, 1))
+    return np.degrees(arc) * MILES_PER_DEGREE
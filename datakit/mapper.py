@@ -18,12 +18,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import time
+from collections import OrderedDict
 from itertools import izip
 
 import numpy as np
 import pandas as pd
 from sklearn.base import BaseEstimator
 
+from util import cpu_time, current_rss
+
 class FeatureMapper(BaseEstimator):
     """
     Class for aggregating feature generation on a DataFrame.
@@ -38,35 +42,101 @@ class FeatureMapper(BaseEstimator):
         Uses a rules-based approach to extract features.
         - Column names are mapped to metadata, which is an arbitrary
           hashable python object (e.g., a tuple or namedtuple).
+          metadata may be a dict or a sequence of (column, metadata)
+          pairs; a column may be a tuple of names for mappers that
+          work on several columns at once.
 
         - Rules are defined in terms of a mapping:
           metadata -> (MapperClass, [args], {kwargs})
           where the kwargs dict is optional.
+
+        The rules are compiled into a feature plan before the mapper
+        is built:
+        - Entries with the same mapper class, parameters and columns
+          are merged, so each distinct computation is done only once.
+        - Single columns sharing a rule whose mapper class has a true
+          batch_columns attribute are handled together by one mapper
+          instance, in one call per fit/transform.
+        The output still has one block of columns per metadata entry,
+        in metadata order: a merged feature's output is repeated at
+        each entry, and a batched mapper's output is split back into
+        its columns (see the layout parameter of FeatureMapper).
         """
-        features = []
-        for col, md in metadata.iteritems():
+        if hasattr(metadata, 'iteritems'):
+            metadata = metadata.iteritems()
+
+        plan = OrderedDict()
+        entries = []
+        for col, md in metadata:
             try:
                 mapper_params = rules[md]
             except KeyError:
                 msg = 'Col %s has unknown metadata' % col
                 raise RuntimeError(msg)
-            mapper = cls._make_mapper(params)
-            mapper_name = '%s-%s' % (col, mapper.__name__)
-            features.append((mapper_name, col, mapper))
+            if isinstance(col, list):
+                col = tuple(col)
+            mapper_cls, args, kwargs = cls._split_params(mapper_params)
+            batched = (isinstance(col, basestring) and 
+                       getattr(mapper_cls, 'batch_columns', False))
+            key = (mapper_cls, repr(args), repr(sorted(kwargs.items())),
+                   None if batched else col)
+            if key not in plan:
+                plan[key] = (mapper_params, [])
+            columns = plan[key][1]
+            if col not in columns:
+                columns.append(col)
+            entries.append((key, col))
+
+        # where each entry's output comes from: (feature index, column of
+        # a batched feature's output, or None for all of it)
+        keys = list(plan)
+        layout = []
+        for key, col in entries:
+            columns = plan[key][1]
+            part = columns.index(col) if len(columns) > 1 else None
+            layout.append((keys.index(key), part))
+
+        features = []
+        used_names = set()
+        for mapper_params, columns in plan.itervalues():
+            mapper = cls._make_mapper(mapper_params)
+            if len(columns) > 1:
+                col_name = ','.join(columns)
+            else:
+                columns = columns[0]
+                if isinstance(columns, tuple):
+                    col_name = ','.join(columns)
+                    columns = list(columns)
+                else:
+                    col_name = columns
+            mapper_name = '%s-%s' % (col_name, mapper.__class__.__name__)
+            # e.g. a tuple column ('a', 'b') and a batch of the columns a
+            # and b under the same rule would otherwise share a name
+            base_name, i = mapper_name, 1
+            while mapper_name in used_names:
+                i += 1
+                mapper_name = '%s-%d' % (base_name, i)
+            used_names.add(mapper_name)
+            features.append((mapper_name, columns, mapper))
 
-        return cls(features)
+        return cls(features, layout=layout)
 
     @staticmethod
-    def _make_mapper(params):
+    def _split_params(params):
         if len(params) == 2:
             mapper, args = params
             kwargs = {}
         else:
             mapper, args, kwargs = params
+        return mapper, tuple(args), kwargs
 
+    @staticmethod
+    def _make_mapper(params):
+        mapper, args, kwargs = FeatureMapper._split_params(params)
         return mapper(*args, **kwargs)
 
-    def __init__(self, features):
+    def __init__(self, features, profile=False, profile_callback=None,
+                 layout=None):
         """
         Parameters
         ----------
@@ -78,10 +148,26 @@ class FeatureMapper(BaseEstimator):
            "mapper" is an instance of an object implementing the fit,
            transform, and fit_transform methods specified by the scikit-learn
            interface.
+        profile : boolean
+           If True, record wall time, CPU time, output shape, density and
+           memory for every feature on each call to fit, transform and
+           fit_transform.  See profile_report.
+        profile_callback : callable or None
+           If given, called with each profiling record (a dict) as soon
+           as it is made.  Implies profiling.
+        layout : list of (feature index, part) pairs or None
+           If given, the output is assembled from these pieces in order,
+           instead of from each feature's output once in feature order.
+           part is None for a feature's whole output, or the index of a
+           column of its (2D) output.  Set by from_rules.
         """
         self.features = features
         self.named_features = {name: mapper 
                                for name, _, mapper in self.features}
+        self.profile = profile
+        self.profile_callback = profile_callback
+        self.profile_records = []
+        self.layout = layout
         super(FeatureMapper, self).__init__()
 
     def fit(self, X, y=None):
@@ -89,7 +175,23 @@ class FeatureMapper(BaseEstimator):
         Fit individual extractors to data.
         """
         for feature_name, columns, extractor in self.features:
-            extractor.fit(X[columns], y)
+            self._run_feature('fit', feature_name, extractor.fit,
+                              X[columns], y)
+        return self
+
+    def partial_fit(self, X, y=None):
+        """
+        Update individual extractors with a chunk of data.  Calling this
+        once per chunk of an event stream fits the mapper in a single
+        pass without holding the full data set in memory.
+        Every extractor must implement partial_fit; pipelines are
+        partially fit step by step.
+        """
+        for feature_name, columns, extractor in self.features:
+            self._run_feature('partial_fit', feature_name,
+                              _partial_fit_extractor, extractor, 
+                              X[columns], y)
+        return self
 
     def transform(self, X):
         """
@@ -97,21 +199,11 @@ class FeatureMapper(BaseEstimator):
         """
         extracted = []
         for feature_name, columns, extractor in self.features:
-
-            feature = extractor.transform(X[columns])
-
-            if hasattr(feature, 'toarray'):
-                feature = feature.toarray()
-            if feature.ndim == 1:
-                feature = feature.reshape((len(feature), 1))
+            feature = self._run_feature('transform', feature_name,
+                                        extractor.transform, X[columns])
             extracted.append(feature)
 
-        if len(extracted) > 0:
-            result = np.concatenate(extracted, axis=1)
-        else:
-            result = extracted[0]
-
-        return result
+        return self._stack_features(self._arrange(extracted))
 
     def fit_transform(self, X, y=None):
         """
@@ -121,12 +213,81 @@ class FeatureMapper(BaseEstimator):
         extracted = []
 
         for feature_name, column_names, extractor in self.features:
-            feature = extractor.fit_transform(X[column_names], y)
+            feature = self._run_feature('fit_transform', feature_name,
+                                        extractor.fit_transform, 
+                                        X[column_names], y)
+            extracted.append(feature)
+
+        return self._stack_features(self._arrange(extracted))
+
+    def profile_report(self, as_frame=True):
+        """
+        Return the profiling records collected so far, one per feature
+        per call, as a DataFrame (or a list of dicts if as_frame is
+        False).  Fields are:
+
+        feature, stage: feature name and the method that was called
+        wall_time, cpu_time: seconds spent in the extractor
+        shape, density, nbytes: shape of the output, fraction of
+            nonzero entries, and bytes held by the output array(s)
+        rss_growth: change in the current resident set size of the
+            process over the call, in bytes: the memory the extractor
+            left allocated, including its output.  Temporary memory
+            freed within the call doesn't show, and the value may be
+            negative.  NaN where /proc/self/statm is not available.
+        """
+        if as_frame:
+            columns = ['feature', 'stage', 'wall_time', 'cpu_time', 
+                       'shape', 'density', 'nbytes', 'rss_growth']
+            return pd.DataFrame(self.profile_records, columns=columns)
+        else:
+            return list(self.profile_records)
+
+    def clear_profile(self):
+        self.profile_records = []
+
+    def _run_feature(self, stage, feature_name, fn, *args):
+        # Call fn on the feature data, recording a profile entry if
+        # profiling is switched on.
+        if not self.profile and self.profile_callback is None:
+            return fn(*args)
+
+        start_rss = current_rss()
+        start_cpu = cpu_time()
+        start_wall = time.time()
+        result = fn(*args)
+        record = {'feature': feature_name,
+                  'stage': stage,
+                  'wall_time': time.time() - start_wall,
+                  'cpu_time': cpu_time() - start_cpu,
+                  'rss_growth': current_rss() - start_rss}
+        record.update(_describe_output(result))
+
+        self.profile_records.append(record)
+        if self.profile_callback is not None:
+            self.profile_callback(record)
+        return result
+
+    def _arrange(self, extracted):
+        # pieces of the feature outputs in the order given by layout
+        if self.layout is None:
+            return extracted
+        pieces = []
+        for i, part in self.layout:
+            feature = extracted[i]
+            if part is not None:
+                feature = feature[:, part]
+            pieces.append(feature)
+        return pieces
+
+    @staticmethod
+    def _stack_features(extracted):
+        for i, feature in enumerate(extracted):
             if hasattr(feature, 'toarray'):
                 feature = feature.toarray()
             if feature.ndim == 1:
                 feature = feature.reshape((len(feature), 1))
-            extracted.append(feature)
+            extracted[i] = feature
 
         if len(extracted) > 0:
             result = np.concatenate(extracted, axis=1)
@@ -144,3 +305,34 @@ class FeatureMapper(BaseEstimator):
                 for key, value in feature.get_params(deep=True).iteritems():
                     out['{0}__{1}'.format(name, key)] = value
             return out
+
+def _partial_fit_extractor(extractor, X, y=None):
+    # sklearn Pipelines don't implement partial_fit, so feed the chunk
+    # through each step in turn
+    if hasattr(extractor, 'steps'):
+        Xt = X
+        for name, step in extractor.steps[:-1]:
+            step.partial_fit(Xt, y)
+            Xt = step.transform(Xt)
+        extractor.steps[-1][1].partial_fit(Xt, y)
+    else:
+        extractor.partial_fit(X, y)
+
+def _describe_output(feature):
+    # shape, density and memory footprint of an extractor's output;
+    # fit methods return None or the extractor, which have no shape
+    if not hasattr(feature, 'shape'):
+        return {'shape': None, 'density': None, 'nbytes': None}
+
+    size = np.prod(feature.shape)
+    if hasattr(feature, 'nnz'):
+        nnz = feature.nnz
+        nbytes = sum(getattr(feature, attr).nbytes 
+                     for attr in ('data', 'indices', 'indptr', 'row', 'col')
+                     if hasattr(feature, attr))
+    else:
+        feature = np.asarray(feature)
+        nnz = np.count_nonzero(feature)
+        nbytes = feature.nbytes
+    density = nnz / float(size) if size > 0 else 0.0
+    return {'shape': feature.shape, 'density': density, 'nbytes': nbytes}
@@ -254,6 +254,32 @@ class EventBuilder(object):
                 xt = cache.transform_one(cache_key, xt)
             yield xt
 
+    def iter_event_chunks(self, X, chunksize=10000):
+        """
+        Chunked iterator interface to build_events.  Yields DataFrames of
+        at most chunksize events, e.g. for use with partial_fit.
+
+        Parameters
+        ----------
+        X : iterable of dict-like or dict-like
+            Data to be transformed.
+        chunksize : int
+            Maximum number of events per yielded DataFrame.
+        """
+        result = defaultdict(list)
+        n = 0
+        for xt in self.iter_events(X):
+            for key, val in xt.iteritems():
+                result[key].append(val)
+            n += 1
+            if n == chunksize:
+                yield pd.DataFrame(result)
+                result = defaultdict(list)
+                n = 0
+
+        if n > 0:
+            yield pd.DataFrame(result)
+
 def make_cache_from_db(name, db_table, db_columns, key,
                        where=None, group_by=None):
     """
@@ -0,0 +1,84 @@
+# Copyright (c) 2013 Andrew Werner and Anthony DeGangi
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# Process pool helpers.  Large inputs (training data, fold indices, fitted
+# lookup tables) are published in a module-level registry just before the
+# pool forks, so every worker inherits them through copy-on-write shared
+# memory instead of having them pickled once per task.  This relies on the
+# fork start method, i.e. a POSIX platform.
+#
+# Pool workers are daemonic and may not start pools of their own, so when
+# run_tasks is called from inside a worker (e.g. a SparseIndicator with
+# n_jobs != 1 being transformed in a cv_dataframe fold that itself runs
+# in a pool) the tasks run serially in that worker.  Parallelism then
+# comes from the outer n_jobs only.
+
+import multiprocessing
+
+_shared = {}
+
+def effective_n_jobs(n_jobs):
+    """Number of worker processes to use; negative values count back
+    from the number of CPUs, so -1 means all of them."""
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    else:
+        return max(n_jobs, 1)
+
+def run_tasks(fn, tasks, shared=None, n_jobs=1):
+    """
+    Evaluate fn(shared, *task) for each task, returning the results in
+    task order.
+
+    Parameters:
+    ----------
+    fn: a module-level function (so that it can be pickled), taking the
+       shared dict as its first argument.
+
+    tasks: sequence of argument tuples.  These are pickled and sent to
+       the workers, so they should be small.
+
+    shared: dict of objects needed by every task.  These are inherited
+       by the workers when the pool is created, never pickled.
+
+    n_jobs: number of worker processes.  With 1, or when called from
+       a daemonic process such as a pool worker, tasks run in the
+       calling process.
+    """
+    if shared is None:
+        shared = {}
+    n_jobs = min(effective_n_jobs(n_jobs), max(len(tasks), 1))
+    if n_jobs == 1 or multiprocessing.current_process().daemon:
+        return [fn(shared, *task) for task in tasks]
+
+    _shared.clear()
+    _shared.update(shared)
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        return pool.map(_run_task, [(fn, task) for task in tasks],
+                        chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+        _shared.clear()
+
+def _run_task(args):
+    fn, task = args
+    return fn(_shared, *task)
@@ -0,0 +1,245 @@
+import sys
+sys.path.append('..')
+sys.path.append('../..')
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from math import degrees, radians, sin, cos, acos
+
+import numpy as np
+import pandas as pd
+
+from util import check_any_null, is_number
+from datakit.mapper import FeatureMapper
+from datakit.extractors.extractors import Binner, ValueCounter
+from datakit.extractors.sparse import SparseIndicator
+from datakit.extractors.zipcodes import USPostMapper, UKPostMapper, \
+    DistanceCalculator
+
+# Checks that the vectorized extractors give the same output as the
+# row-by-row implementations they replaced, which are reproduced here.
+
+def same(result, expected, **kwargs):
+    # allclose, with NaNs required in the same places
+    result, expected = np.asarray(result), np.asarray(expected)
+    nan = np.isnan(expected)
+    return ((np.isnan(result) == nan).all() and 
+            np.allclose(result[~nan], expected[~nan], **kwargs))
+
+def old_value_counter(X_fit, y, X, target_value=1):
+    hits, total = defaultdict(float), defaultdict(float)
+    all_hits, grand_total = 0.0, 0.0
+    key_factory = tuple if X_fit.ndim > 1 else (lambda x: x)
+    for row, value in zip(X_fit, y):
+        hit_count = 1 if value == target_value else 0
+        grand_total += 1
+        all_hits += hit_count
+        key = key_factory(row)
+        if not check_any_null(key):
+            total[key] += 1
+            hits[key] += hit_count
+
+    result = np.empty(X.shape[0])
+    for i, row in enumerate(X):
+        key = key_factory(row)
+        if key in total:
+            result[i] = hits.get(key, 0) / float(total[key])
+        else:
+            result[i] = all_hits / float(grand_total)
+    return result
+
+def old_sparse_indicator(X_fit, X, delim=','):
+    id_lookup = {}
+    for x in X_fit:
+        for tok in x.split(delim):
+            if tok not in id_lookup:
+                id_lookup[tok] = len(id_lookup)
+    result = np.zeros((len(X), len(id_lookup)))
+    for i, x in enumerate(X):
+        for tok in x.split(delim):
+            if tok in id_lookup:
+                result[i, id_lookup[tok]] += 1
+    return result
+
+def old_code_map(csvfile, normalize, average):
+    code_map, counts = {}, defaultdict(float)
+    df = pd.read_csv(csvfile, converters={'code': str})
+    for _, row in df.iterrows():
+        code = row['code']
+        if not code:
+            continue
+        norm_code = normalize(code)
+        lat, lng = row['lat'], row['lng']
+        if not average:
+            code_map[norm_code] = (lat, lng)
+        elif not (pd.isnull(lat) or pd.isnull(lng)):
+            N = counts[norm_code]
+            old_lat, old_lng = code_map.get(norm_code, (0, 0))
+            code_map[norm_code] = ((N*old_lat + lat) / (N + 1.0),
+                                   (N*old_lng + lng) / (N + 1.0))
+            counts[norm_code] += 1.0
+    return code_map
+
+def old_distance(X, lookups):
+    def get_coordinate(code):
+        for lookup in lookups:
+            coord = lookup(code)
+            if coord is not None:
+                return coord
+        return None
+
+    result = np.empty(X.shape[0])
+    for i, row in enumerate(X):
+        if check_any_null(row):
+            result[i] = np.nan
+            continue
+        coord_a, coord_b = [get_coordinate(code) for code in row]
+        if check_any_null((coord_a, coord_b)):
+            result[i] = np.nan
+            continue
+        (lat_a, lng_a), (lat_b, lng_b) = coord_a, coord_b
+        if np.isnan([lat_a, lng_a, lat_b, lng_b]).any():
+            result[i] = np.nan
+            continue
+        lat_a, lat_b = radians(lat_a), radians(lat_b)
+        cos_arc = (sin(lat_a) * sin(lat_b) +
+                   cos(lat_a) * cos(lat_b) * cos(radians(lng_a - lng_b)))
+        result[i] = degrees(acos(min(max(cos_arc, -1), 1))) * 69.09
+    return result
+
+def check_value_counter():
+    rng = np.random.RandomState(0)
+    keys = np.array(['a', 'b', 'c', None, np.nan, 'd'], dtype=object)
+    X_fit = keys[rng.randint(0, 5, 200)]
+    y = rng.randint(0, 2, 200)
+    # 'd' and 'e' are never seen in fit
+    X = np.concatenate([keys, ['e']])
+    counter = ValueCounter(1).fit(X_fit, y)
+    assert same(counter.transform(X), old_value_counter(X_fit, y, X))
+
+    # multi-column keys, with nulls in either column
+    X_fit = np.column_stack([keys[rng.randint(0, 6, 200)],
+                             rng.randint(0, 3, 200).astype(object)])
+    X = np.array([['a', 0], ['a', 1], [None, 1], ['b', np.nan],
+                  ['d', 2], ['z', 0]], dtype=object)
+    counter = ValueCounter(1).fit(X_fit, y)
+    assert same(counter.transform(X), old_value_counter(X_fit, y, X))
+    assert same(counter.fit_transform(X_fit, y),
+                old_value_counter(X_fit, y, X_fit))
+
+def check_value_counter_oof():
+    # each fold's out-of-fold encoding should match a counter fit on the
+    # other folds only
+    rng = np.random.RandomState(1)
+    keys = np.array(['a', 'b', 'c', 'd', None, np.nan], dtype=object)
+    n = 300
+    y = rng.randint(0, 2, n)
+    fold_ids = rng.permutation(n) % 3
+    X_1d = keys[rng.randint(0, 6, n)]
+    X_2d = np.column_stack([keys[rng.randint(0, 6, n)],
+                            rng.randint(0, 4, n).astype(object)])
+    for X in (X_1d, X_2d):
+        for min_count in (1, 5):
+            result = ValueCounter(1, min_count=min_count).fit_transform_oof(
+                X, y, fold_ids)
+            for fold in xrange(3):
+                test = fold_ids == fold
+                counter = ValueCounter(1, min_count=min_count)
+                counter.fit(X[~test], y[~test])
+                assert same(result[test], counter.transform(X[test]))
+
+        # with oof_folds set, transform still uses counts over all rows
+        counter = ValueCounter(1, oof_folds=3)
+        counter.fit_transform(X, y)
+        assert same(counter.transform(X), 
+                    ValueCounter(1).fit(X, y).transform(X))
+
+def check_sparse_indicator():
+    X_fit = np.array(['a,b,c', 'b', 'c,c,d', ''], dtype=object)
+    # 'x' and 'y' are unknown tokens
+    X = np.array(['a,x', 'd,b,y', '', 'c,c'], dtype=object)
+    indicator = SparseIndicator().fit(X_fit)
+    assert same(indicator.transform(X).toarray(),
+                old_sparse_indicator(X_fit, X))
+    assert same(SparseIndicator().fit_transform(X_fit).toarray(),
+                old_sparse_indicator(X_fit, X_fit))
+    assert indicator.transform(X[:0]).shape == (0, indicator.ncol)
+
+def check_distance_calculator():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        us_file = os.path.join(tmpdir, 'us.csv')
+        pd.DataFrame({'code': ['10001', '94103', '60601', '10001'],
+                      'lat': [40.75, 37.77, 41.88, 40.76],
+                      'lng': [-73.99, -122.41, -87.62, -73.98]}
+                     ).to_csv(us_file, index=False)
+        uk_file = os.path.join(tmpdir, 'uk.csv')
+        pd.DataFrame({'code': ['SW1A 1AA', 'SW1A 2AA', 'EH1 1YZ', 'M1 1AE'],
+                      'lat': [51.50, 51.51, 55.95, np.nan],
+                      'lng': [-0.14, -0.13, -3.19, -2.23]}
+                     ).to_csv(uk_file, index=False)
+
+        us, uk = (USPostMapper(us_file, 'code', 'lat', 'lng'),
+                  UKPostMapper(uk_file, 'code', 'lat', 'lng'))
+        us_map = old_code_map(us_file, us.normalize, average=False)
+        uk_map = old_code_map(uk_file, uk.normalize, average=True)
+        def us_lookup(code):
+            code = us.normalize(code)
+            return us_map.get(code[:5]) if is_number(code) else None
+        def uk_lookup(code):
+            return uk_map.get(uk.normalize(code))
+
+        X = np.array([['10001', '94103'], ['10001-1234', 'sw1a 3zz'],
+                      ['SW1A 1AA', 'EH1 1YZ'], ['M1 9ZZ', '60601'],
+                      [None, '60601'], ['99999', '10001'],
+                      ['eh1', '94103'], ['10001', '94103']], dtype=object)
+        for cache_size in (0, 4):
+            calculator = DistanceCalculator([us, uk], cache_size=cache_size)
+            calculator.fit(X)
+            expected = old_distance(X, [us_lookup, uk_lookup])
+            for _ in xrange(2):
+                result = calculator.transform(X)
+                assert same(result, expected, rtol=1e-6, atol=1e-3)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def check_from_rules():
+    # the compiled plan (merged duplicates, batched Binner columns) gives
+    # the same matrix as one mapper per metadata entry
+    rng = np.random.RandomState(2)
+    df = pd.DataFrame({'a': rng.randn(100), 'b': rng.randn(100), 
+                       'c': rng.randint(0, 4, 100)})
+    y = rng.randint(0, 2, 100)
+    rules = {'num': (Binner, [4]),
+             'pair': (Binner, [4]),
+             'key': (ValueCounter, [1], {'min_count': 2})}
+    metadata = [('a', 'num'), ('c', 'key'), (('a', 'b'), 'pair'), 
+                ('b', 'num'), ('a', 'num')]
+
+    mapper = FeatureMapper.from_rules(metadata, rules)
+    # the tuple column and the batch of a and b get distinct names
+    names = [name for name, _, _ in mapper.features]
+    assert len(set(names)) == len(names) == len(mapper.named_features)
+
+    features = []
+    for i, (col, md) in enumerate(metadata):
+        params = rules[md]
+        kwargs = params[2] if len(params) > 2 else {}
+        columns = list(col) if isinstance(col, tuple) else col
+        features.append((str(i), columns, params[0](*params[1], **kwargs)))
+    reference = FeatureMapper(features)
+
+    assert same(mapper.fit_transform(df, y), reference.fit_transform(df, y))
+    assert same(mapper.transform(df), reference.transform(df))
+
+def run_tests():
+    check_value_counter()
+    check_value_counter_oof()
+    check_sparse_indicator()
+    check_from_rules()
+    check_distance_calculator()
+    print 'All equivalence checks passed'
+
+if __name__ == '__main__':
+    run_tests()
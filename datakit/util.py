@@ -21,6 +21,7 @@
 # collection of utility functions
 
 import datetime
+import os
 import time
 import calendar
 import collections
@@ -44,6 +45,60 @@ def check_any_null(X):
     else:
         return (X is None or pd.isnull(X))
 
+# Integer code for the key in each row of X (a 1D array of keys, or a
+# 2D array whose rows are keys), numbered in order of first appearance,
+# with -1 for keys containing a null.  Also returns the index of the
+# first row holding each code, so that per-key work can be done once
+# per distinct key and broadcast back with codes.
+def factorize_rows(X):
+    if X.ndim == 1:
+        codes, _ = pd.factorize(X)
+    else:
+        null = np.zeros(len(X), dtype=bool)
+        combined = np.zeros(len(X), dtype=np.int64)
+        for j in xrange(X.shape[1]):
+            col_codes, col_uniques = pd.factorize(X[:, j])
+            null |= col_codes < 0
+            combined = (combined * len(col_uniques) + 
+                        np.maximum(col_codes, 0))
+            # renumber densely so the combined codes can't overflow
+            combined, _ = pd.factorize(combined)
+        codes = np.empty(len(X), dtype=np.int64)
+        codes[null] = -1
+        codes[~null], _ = pd.factorize(combined[~null])
+
+    order = np.argsort(codes, kind='mergesort')
+    n_keys = codes.max() + 1 if len(codes) else 0
+    first = order[np.searchsorted(codes[order], np.arange(n_keys))]
+    return codes, first
+
+# dict with a bounded number of entries, discarding the least recently
+# used entry when full
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
 # convert a datetime to epoch time
 def convert_datetime_epoch(dt):
     return time.mktime(dt.timetuple())
@@ -72,3 +127,18 @@ def is_number(s):
 def maybe_print(s, verbose=True):
     if verbose:
         print s
+
+# CPU time (user + system) consumed by this process, in seconds
+def cpu_time():
+    user, system = os.times()[:2]
+    return user + system
+
+# current resident set size of this process, in bytes; NaN where
+# /proc/self/statm is not available (i.e. other than on Linux)
+def current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return np.nan
+    return pages * os.sysconf('SC_PAGE_SIZE')